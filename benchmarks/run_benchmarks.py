@@ -0,0 +1,222 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmarks for point generation, masking and NTv2 writing on synthetic
+data. Every case runs in its own process so that its peak RSS can be
+reported; results are printed as one JSON object per line.
+
+    python benchmarks/run_benchmarks.py --sizes 1e4,1e6,1e8 --output out.jsonl
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "ntv2generator"))
+
+import numpy as np
+
+import instrumentation
+import ntv2writer
+
+
+CASES = ["generator", "write_binary", "write_ascii"]
+
+# synthetic area, roughly the size of Romania
+CENTER_LONG = 25.0
+CENTER_LAT = 46.0
+EXTENT_LONG = 8.0
+EXTENT_LAT = 5.0
+
+
+def _increment_for(nodes):
+    # square cells (in arc-seconds) giving about `nodes` bounding box nodes
+    area = EXTENT_LONG * 3600 * EXTENT_LAT * 3600
+    return math.sqrt(area / float(nodes))
+
+
+def synthetic_polygon(vertices=2000, seed=0):
+    # irregular star-shaped ring, closed
+    rng = np.random.RandomState(seed)
+    angles = np.linspace(0, 2 * math.pi, vertices, endpoint=False)
+    radius = 0.8 + 0.2 * np.sin(5 * angles) + 0.03 * rng.rand(vertices)
+    ring = np.column_stack([CENTER_LONG + radius * np.cos(angles) * EXTENT_LONG / 2,
+                            CENTER_LAT + radius * np.sin(angles) * EXTENT_LAT / 2])
+    return np.vstack([ring, ring[:1]])
+
+
+def write_geojson(ring, file_path):
+    with open(file_path, "w") as output:
+        json.dump({"type": "FeatureCollection",
+                   "features": [{"type": "Feature", "properties": {},
+                                 "geometry": {"type": "Polygon",
+                                              "coordinates": [ring.tolist()]}}]},
+                  output)
+
+
+def synthetic_subfile(nodes):
+    increment = _increment_for(nodes)
+    south = (CENTER_LAT - EXTENT_LAT / 2) * 3600
+    west = (CENTER_LONG - EXTENT_LONG / 2) * 3600
+    rows = int(EXTENT_LAT * 3600 / increment) + 1
+    cols = int(EXTENT_LONG * 3600 / increment) + 1
+    subfile = ntv2writer.NTv2SubFile("SYNTH")
+    subfile.set_limits(ntv2writer.BoundingBox(south + (rows - 1) * increment,
+                                              south, west,
+                                              west + (cols - 1) * increment))
+    subfile.set_coord_increment(increment, increment, counts=(rows, cols))
+    subfile.set_dates(datetime.datetime(2000, 1, 1))
+
+    # smooth synthetic shift field, in arc-seconds
+    lat = np.linspace(0, 1, rows, dtype=np.float32)[:, None]
+    lon = np.linspace(0, 1, cols, dtype=np.float32)[None, :]
+    shifts = np.empty((rows, cols, 4), ntv2writer.RECORD_DTYPE)
+    shifts[:, :, 0] = 1.5 + 0.3 * lat + 0.1 * np.sin(6 * lon)
+    shifts[:, :, 1] = -2.0 + 0.2 * lon + 0.1 * np.cos(4 * lat)
+    shifts[:, :, 2] = 0.01
+    shifts[:, :, 3] = 0.01
+    subfile.set_gridshifts(shifts.reshape(-1, 4))
+    return subfile
+
+
+def _timed(results, stage, nodes, func, *args, **kwargs):
+    start = time.time()
+    value = func(*args, **kwargs)
+    elapsed = time.time() - start
+    results.append({"stage": stage, "nodes": nodes, "wall_time_s": elapsed,
+                    "nodes_per_s": nodes / elapsed if elapsed > 0 else None})
+    return value
+
+
+def run_generator_case(nodes, work_dir):
+    import pointgenerator
+
+    results = []
+    polygon_file = os.path.join(work_dir, "area.geojson")
+    write_geojson(synthetic_polygon(), polygon_file)
+    generator = _timed(results, "open", 0, pointgenerator.Generator,
+                       polygon_file)
+    increment = _increment_for(nodes)
+    _timed(results, "set_increments", 0, generator.set_increments,
+           increment, increment)
+    node_count = (generator.lat_count + 1) * (generator.long_count + 1)
+    # setup stages do not process nodes, they only report the grid size
+    for result in results:
+        result["nodes"] = node_count
+        result["nodes_per_s"] = None
+    _timed(results, "generate_points", node_count, generator.generate_points)
+    mask = _timed(results, "select_valid_points", node_count,
+                  generator.select_valid_points)
+    paths = _timed(results, "dump_to_file", int(mask.sum()),
+                   generator.dump_to_file,
+                   os.path.join(work_dir, "points.txt"))
+    results[-1]["bytes"] = sum(os.path.getsize(path) for path in paths)
+    return results
+
+
+def run_write_case(nodes, work_dir, f_format):
+    results = []
+    subfile = synthetic_subfile(nodes)
+    ntv2_file = ntv2writer.NTv2File()
+    ntv2_file.set_ref_systems(ntv2writer.ETRS89_CRS, ntv2writer.ETRS89_CRS)
+    ntv2_file.add_subfile(subfile)
+    name = "synthetic.gs" + f_format
+    _timed(results, "write_to_file", subfile.gs_count, ntv2_file.write_to_file,
+           work_dir, name, f_format, True)
+    results[-1]["bytes"] = os.path.getsize(os.path.join(work_dir, name))
+    return results
+
+
+def run_case(case, nodes):
+    work_dir = tempfile.mkdtemp(prefix="ntv2bench")
+    try:
+        if case == "generator":
+            results = run_generator_case(nodes, work_dir)
+        elif case == "write_binary":
+            results = run_write_case(nodes, work_dir, "b")
+        elif case == "write_ascii":
+            results = run_write_case(nodes, work_dir, "a")
+        else:
+            raise Exception("Unknown benchmark case " + case)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    peak = instrumentation.peak_rss_bytes()
+    for result in results:
+        result["case"] = case
+        result["target_nodes"] = nodes
+        result["peak_rss_bytes"] = peak
+        if "bytes" in result and result["wall_time_s"] > 0:
+            result["bytes_per_s"] = result["bytes"] / result["wall_time_s"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[-2])
+    parser.add_argument("--sizes", default="1e4,1e5,1e6",
+                        help="comma separated node counts (up to 1e8)")
+    parser.add_argument("--cases", default=",".join(CASES),
+                        help="comma separated subset of " + ", ".join(CASES))
+    parser.add_argument("--output", help="JSON lines file (default stdout)")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--nodes", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # child process running a single case
+        for result in run_case(args.case, int(args.nodes)):
+            print(json.dumps(result))
+        return
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    environment = {"python": platform.python_version(),
+                   "numpy": np.__version__,
+                   "platform": platform.platform(),
+                   "timestamp": datetime.datetime.now().isoformat()}
+    try:
+        for nodes in [int(float(size)) for size in args.sizes.split(",")]:
+            for case in args.cases.split(","):
+                child = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__),
+                     "--case", case, "--nodes", str(nodes)],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                stdout, stderr = child.communicate()
+                if child.returncode != 0:
+                    result = {"case": case, "target_nodes": nodes,
+                              "error": stderr.decode("utf-8", "replace")
+                              .strip().splitlines()[-1:]}
+                    output.write(json.dumps(dict(result, **environment)) + "\n")
+                    continue
+                for line in stdout.decode("utf-8").splitlines():
+                    result = json.loads(line)
+                    result.update(environment)
+                    output.write(json.dumps(result) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
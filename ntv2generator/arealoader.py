@@ -0,0 +1,146 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+Reads area polygons from GeoJSON or WKT without GDAL.
+"""
+
+import json
+import os
+import re
+
+import numpy as np
+
+
+GEOJSON_EXTENSIONS = (".geojson", ".json")
+WKT_EXTENSIONS = (".wkt",)
+
+_WKT_POINT = re.compile(r"([-+.\deE]+)\s+([-+.\deE]+)(?:\s+[-+.\deE]+)*")
+_WKT_PREFIX = re.compile(r"^\s*(MULTI)?POLYGON\b", re.IGNORECASE)
+_WKT_GEOMETRY = re.compile(
+    r"^\s*(MULTIPOLYGON|POLYGON)(?:\s+(?:ZM|Z|M))?\s*(\(.*\))\s*$",
+    re.IGNORECASE | re.DOTALL)
+# GeoJSON "crs" names meaning WGS84 longitude/latitude
+_WGS84_NAMES = ("urn:ogc:def:crs:OGC:1.3:CRS84", "urn:ogc:def:crs:OGC::CRS84",
+                "urn:ogc:def:crs:EPSG::4326", "EPSG:4326")
+
+
+class RingGeometry:
+    """Polygon (or multipolygon) read without OGR: a list of polygons,
+    each a list of (n, 2) arrays of (longitude, latitude) rings, the first
+    one being the exterior ring."""
+
+    def __init__(self, polygons):
+        self.polygons = polygons
+
+    @property
+    def rings(self):
+        return [ring for polygon in self.polygons for ring in polygon]
+
+    def GetEnvelope(self):
+        # same order as OGR: (min x, max x, min y, max y)
+        points = np.concatenate(self.rings)
+        return (points[:, 0].min(), points[:, 0].max(),
+                points[:, 1].min(), points[:, 1].max())
+
+    def ExportToWkt(self):
+        return "MULTIPOLYGON ({0})".format(", ".join(
+            "({0})".format(", ".join(
+                "({0})".format(", ".join("%r %r" % tuple(point)
+                                         for point in ring.tolist()))
+                for ring in polygon))
+            for polygon in self.polygons))
+
+
+def _is_wkt_text(source):
+    # a WKT string rather than a file name such as "polygon.shp"
+    return (_WKT_PREFIX.match(source) is not None and "(" in source and
+            not os.path.exists(source))
+
+
+def is_supported(source):
+    """Tells if source (a file name or a WKT string) can be read here."""
+    if not isinstance(source, str):
+        return False
+    if _is_wkt_text(source):
+        return True
+    return source.lower().endswith(GEOJSON_EXTENSIONS + WKT_EXTENSIONS)
+
+
+def _as_ring(coordinates):
+    ring = np.asarray(coordinates, dtype=float)
+    if ring.ndim != 2 or ring.shape[1] < 2:
+        raise Exception("Invalid polygon ring!")
+    return ring[:, :2]
+
+
+def _geojson_polygons(geometry):
+    if geometry is None:
+        raise Exception("Unable to read geometry")
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        raise Exception("A polygon input is required!")
+    return [[_as_ring(ring) for ring in polygon] for polygon in polygons]
+
+
+def _geojson_features(data, verify_gcs):
+    crs = data.get("crs")
+    if verify_gcs and crs is not None:
+        name = crs.get("properties", {}).get("name")
+        if name not in _WGS84_NAMES:
+            raise Exception("Input must be in WGS84!")
+    if data["type"] == "FeatureCollection":
+        features = data["features"]
+    elif data["type"] == "Feature":
+        features = [data]
+    else:
+        features = [{"type": "Feature", "properties": {}, "geometry": data}]
+    return [(feature.get("properties") or {},
+             _geojson_polygons(feature.get("geometry")))
+            for feature in features]
+
+
+def parse_wkt(text):
+    """Reads a POLYGON or MULTIPOLYGON WKT string into a list of
+    polygons (see RingGeometry)."""
+    match = _WKT_GEOMETRY.match(text)
+    if match is None:
+        raise Exception("A polygon input is required!")
+    # "x y" pairs become JSON arrays, so the nesting is parsed by json
+    nested = _WKT_POINT.sub(
+        lambda point: "[{0!r},{1!r}]".format(float(point.group(1)),
+                                             float(point.group(2))),
+        match.group(2))
+    nested = json.loads(nested.replace("(", "[").replace(")", "]"))
+    if match.group(1).upper() == "POLYGON":
+        nested = [nested]
+    return [[_as_ring(ring) for ring in polygon] for polygon in nested]
+
+
+def read_features(source, verify_gcs=False):
+    """Returns the (properties, polygons) of every feature of a GeoJSON
+    file, or of the single polygon of a WKT file or string."""
+    if _is_wkt_text(source):
+        return [({}, parse_wkt(source))]
+    if not source.lower().endswith(GEOJSON_EXTENSIONS + WKT_EXTENSIONS):
+        raise Exception("{0} is not a GeoJSON or WKT file!".format(source))
+    with open(source, "r") as input_file:
+        content = input_file.read()
+    if source.lower().endswith(WKT_EXTENSIONS):
+        return [({}, parse_wkt(content))]
+    return _geojson_features(json.loads(content), verify_gcs)
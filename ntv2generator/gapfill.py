@@ -0,0 +1,189 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+Extrapolation of grid shifts into a buffer zone around the area, so that
+interpolating near the border does not mix in the zero shifts outside.
+"""
+
+import math
+
+import numpy as np
+
+import ntv2writer
+
+
+_ORTHOGONAL = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+_DIAGONAL = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+
+def _dilate(mask):
+    # 3x3 dilation, done separately along both axes
+    grown = mask.copy()
+    grown[1:] |= mask[:-1]
+    grown[:-1] |= mask[1:]
+    result = grown.copy()
+    result[:, 1:] |= grown[:, :-1]
+    result[:, :-1] |= grown[:, 1:]
+    return result
+
+
+def buffer_layers(mask, buffer_nodes):
+    """Labels every node with its distance to the area in nodes (largest
+    of the row and column distances): 0 inside, 1 to buffer_nodes in the
+    buffer zone and -1 beyond it."""
+    layers = np.full(mask.shape, -1, dtype=np.int16)
+    layers[mask] = 0
+    known = np.array(mask, dtype=bool)
+    for layer in range(1, buffer_nodes + 1):
+        grown = _dilate(known)
+        ring = grown & ~known
+        if not ring.any():
+            break
+        layers[ring] = layer
+        known = grown
+    return layers
+
+
+def _neighbours(rows, cols, shape, offsets):
+    # (valid, flat index) of the neighbours of the given nodes
+    for row_offset, col_offset in offsets:
+        neighbour_rows = rows + row_offset
+        neighbour_cols = cols + col_offset
+        valid = ((neighbour_rows >= 0) & (neighbour_rows < shape[0]) &
+                 (neighbour_cols >= 0) & (neighbour_cols < shape[1]))
+        yield valid, (np.where(valid, neighbour_rows, 0) * shape[1] +
+                      np.where(valid, neighbour_cols, 0))
+
+
+def _onion_fill(values, layers):
+    # every layer takes the distance weighted mean of its already known
+    # neighbours, working outwards from the area
+    shape = layers.shape
+    flat_layers = layers.ravel()
+    for layer in range(1, int(layers.max()) + 1):
+        nodes = np.flatnonzero(flat_layers == layer)
+        rows, cols = np.divmod(nodes, shape[1])
+        total = np.zeros((len(nodes), values.shape[1]))
+        weights = np.zeros(len(nodes))
+        for offsets, weight in ((_ORTHOGONAL, 1.0),
+                                (_DIAGONAL, 1 / math.sqrt(2))):
+            for valid, neighbours in _neighbours(rows, cols, shape, offsets):
+                neighbour_layers = flat_layers[neighbours]
+                known = valid & (neighbour_layers >= 0) & \
+                    (neighbour_layers < layer)
+                total[known] += weight * values[neighbours[known]]
+                weights[known] += weight
+        values[nodes] = total / weights[:, None]
+
+
+def _harmonic_fill(values, layers, tolerance, max_iterations):
+    # solves the Laplace equation on the buffer nodes, with the area values
+    # as fixed boundary and no flux through the outer edge of the buffer,
+    # by conjugate gradients on the compact set of unknowns (matrix free,
+    # Jacobi preconditioned), starting from the onion fill
+    shape = layers.shape
+    flat_layers = layers.ravel()
+    nodes = np.flatnonzero(flat_layers > 0)
+    if not len(nodes):
+        return 0
+    slots = np.full(flat_layers.shape, len(nodes), dtype=np.intp)
+    slots[nodes] = np.arange(len(nodes))
+    rows, cols = np.divmod(nodes, shape[1])
+
+    neighbour_slots = []
+    degree = np.zeros(len(nodes))
+    rhs = np.zeros((values.shape[1], len(nodes)))
+    for valid, neighbours in _neighbours(rows, cols, shape, _ORTHOGONAL):
+        neighbour_layers = np.where(valid, flat_layers[neighbours], -1)
+        fixed = neighbour_layers == 0
+        rhs[:, fixed] += values[neighbours[fixed]].T
+        degree += neighbour_layers >= 0
+        neighbour_slots.append(np.where(neighbour_layers > 0,
+                                        slots[neighbours], len(nodes)))
+
+    # one row per record value; the search direction keeps a zero column
+    # at the end, taken in place of the neighbours that are not unknowns
+    padded = np.zeros((values.shape[1], len(nodes) + 1))
+    direction = padded[:, :-1]
+    gathered = np.empty_like(direction)
+
+    def apply(vectors, result):
+        np.multiply(degree, vectors[:, :-1], out=result)
+        for neighbour in neighbour_slots:
+            np.take(vectors, neighbour, axis=1, out=gathered)
+            result -= gathered
+        return result
+
+    def dot(a, b):
+        return np.einsum("ij,ij->i", a, b)
+
+    u = values[nodes].T.astype(float)
+    padded[:, :-1] = u
+    residual = rhs - apply(padded, np.empty_like(u))
+    z = residual / degree
+    direction[:] = z
+    rz = dot(residual, z)
+    target = tolerance * np.maximum(np.sqrt(dot(rhs, rhs)), 1e-30)
+    applied = np.empty_like(u)
+    iterations = 0
+    while iterations < max_iterations:
+        if np.all(np.sqrt(dot(residual, residual)) <= target):
+            break
+        apply(padded, applied)
+        denominator = dot(direction, applied)
+        alpha = np.where(denominator > 0, rz / np.where(denominator > 0,
+                                                        denominator, 1), 0)
+        u += alpha[:, None] * direction
+        residual -= alpha[:, None] * applied
+        np.divide(residual, degree, out=z)
+        rz_next = dot(residual, z)
+        beta = np.where(rz > 0, rz_next / np.where(rz > 0, rz, 1), 0)
+        direction *= beta[:, None]
+        direction += z
+        rz = rz_next
+        iterations += 1
+    values[nodes] = u.T
+    return iterations
+
+
+def fill_gridshifts(gridshifts, mask, buffer_nodes=16, method="harmonic",
+                    tolerance=1e-6, max_iterations=2000):
+    """Extrapolates grid shifts into a buffer around the area.
+
+    gridshifts holds the records of a (rows x cols) grid in node order and
+    mask marks the nodes inside the area, whose values are left unchanged.
+    Nodes up to buffer_nodes nodes away from the area get values smoothly
+    continuing the area ones, for all four record values: "harmonic"
+    solves the Laplace equation in the buffer, "onion" fills it layer by
+    layer with distance weighted means (faster, less smooth). Nodes
+    further away keep their values.
+
+    Returns the filled grid shifts (a new array) and the mask of the area
+    with its buffer.
+    """
+    if method not in ("harmonic", "onion"):
+        raise Exception("Unknown fill method: {0}".format(method))
+    mask = np.asarray(mask, dtype=bool)
+    filled = np.array(gridshifts, dtype=ntv2writer.RECORD_DTYPE).reshape(-1, 4)
+    if len(filled) != mask.size:
+        raise Exception("The mask does not match the grid shifts!")
+    layers = buffer_layers(mask, buffer_nodes)
+    if mask.any():
+        # only buffer nodes are written, the area values are only read
+        _onion_fill(filled, layers)
+        if method == "harmonic":
+            _harmonic_fill(filled, layers, tolerance, max_iterations)
+    return filled, layers >= 0
@@ -0,0 +1,195 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+Stage timers, counters and progress reporting for the generation workflow.
+
+Instrumentation is disabled by default. Enable it with
+
+    instrumentation.enable(instrumentation.JSONLinesSink("run.jsonl"))
+
+and every stage (opening the area, generating points, masking, dumping,
+computing and writing grid shifts) then sends JSON events to the sink.
+"""
+
+import json
+import sys
+import time
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere except on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class JSONLinesSink:
+    """Writes every event as one JSON line to a file (a path or an open
+    text file, such as sys.stderr)."""
+
+    def __init__(self, output):
+        if hasattr(output, "write"):
+            self.output = output
+            self.owned = False
+        else:
+            self.output = open(output, "a")
+            self.owned = True
+
+    def __call__(self, event):
+        self.output.write(json.dumps(event, sort_keys=True) + "\n")
+        self.output.flush()
+
+    def close(self):
+        if self.owned:
+            self.output.close()
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def count(self, name, amount=1):
+        pass
+
+    def progress(self, done, total=None):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class NullInstrumentation:
+    """Does nothing; used while instrumentation is disabled."""
+
+    enabled = False
+
+    def stage(self, name, total=None, **fields):
+        return _NULL_STAGE
+
+    def count(self, name, amount=1):
+        pass
+
+    def emit(self, event, **fields):
+        pass
+
+
+class _Stage:
+    def __init__(self, owner, name, total, fields):
+        self.owner = owner
+        self.name = name
+        self.total = total
+        self.fields = fields
+        self.counters = {}
+        self.start = None
+        self.last_progress = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self.last_progress = self.start
+        self.owner.emit("stage_start", stage=self.name, **self.fields)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fields = dict(self.fields)
+        fields.update(self.counters)
+        if exc_type is not None:
+            fields["error"] = "{0}: {1}".format(exc_type.__name__, exc_value)
+        self.owner.emit("stage_end", stage=self.name,
+                        seconds=time.time() - self.start,
+                        peak_rss_bytes=peak_rss_bytes(), **fields)
+        return False
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+        self.owner.count(name, amount)
+
+    def progress(self, done, total=None):
+        """Reports done units out of total (the stage total by default);
+        throttled to one event per progress_interval seconds."""
+        if total is None:
+            total = self.total
+        now = time.time()
+        finished = total is not None and done >= total
+        if (now - self.last_progress < self.owner.progress_interval and
+                not finished):
+            return
+        self.last_progress = now
+        elapsed = now - self.start
+        eta = None
+        if total and done:
+            eta = elapsed * (total - done) / float(done)
+        self.owner.emit("progress", stage=self.name, done=done, total=total,
+                        elapsed=elapsed, eta=eta)
+        if self.owner.progress_callback is not None:
+            self.owner.progress_callback(self.name, done, total, eta)
+
+
+class Instrumentation:
+    """Times stages, keeps counters and sends events to sink, a callable
+    taking a dict. progress_callback(stage, done, total, eta) is called
+    for every progress event."""
+
+    enabled = True
+
+    def __init__(self, sink=None, progress_callback=None,
+                 progress_interval=1.0):
+        self.sink = sink
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.counters = {}
+
+    def stage(self, name, total=None, **fields):
+        return _Stage(self, name, total, fields)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def emit(self, event, **fields):
+        if self.sink is None:
+            return
+        fields["event"] = event
+        fields["time"] = time.time()
+        self.sink(fields)
+
+    def summary(self):
+        self.emit("summary", peak_rss_bytes=peak_rss_bytes(),
+                  **self.counters)
+        return dict(self.counters)
+
+
+_current = NullInstrumentation()
+
+
+def current():
+    return _current
+
+
+def enable(sink=None, progress_callback=None, progress_interval=1.0):
+    """Turns instrumentation on for the whole workflow and returns it."""
+    global _current
+    _current = Instrumentation(sink, progress_callback, progress_interval)
+    return _current
+
+
+def disable():
+    global _current
+    _current = NullInstrumentation()
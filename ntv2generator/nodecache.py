@@ -0,0 +1,229 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+
+VALUE_DTYPE = np.dtype([("easting", "<f8"), ("northing", "<f8"),
+                        ("shifts", "<f4", (4,))])
+
+_LAT_OFFSET = 1 << 30
+_LONG_OFFSET = 1 << 31
+
+
+def node_keys(latitudes, longitudes, quantum):
+    """Packs node coordinates (arc-seconds), rounded to quantum, into one
+    uint64 key per node. Returns the keys and the rounded latitudes and
+    longitudes (in quanta)."""
+    lat_q = np.rint(np.asarray(latitudes, dtype=float) /
+                    quantum).astype(np.int64)
+    long_q = np.rint(np.asarray(longitudes, dtype=float) /
+                     quantum).astype(np.int64)
+    keys = (((lat_q + _LAT_OFFSET) << 32) |
+            (long_q + _LONG_OFFSET)).astype(np.uint64)
+    return keys, lat_q, long_q
+
+
+class NodeCache:
+    """On-disk cache of transformation service results per grid node.
+
+    Entries are keyed by the node coordinates rounded to quantum
+    arc-seconds, inside a namespace derived from the service identity and
+    version, so results of different services never mix. Each entry holds
+    the service result (easting, northing) and the grid shifts computed
+    from it. Nodes are grouped in shards of shard_size x shard_size
+    arc-seconds, each stored as a sorted key array and a value array;
+    when the cache grows over max_bytes the least recently used shards are
+    evicted. Up to loaded_shards shards are also kept in memory.
+
+    Shards are written by store right away, but the index (use times and
+    sizes) only by flush or close, which the generation functions taking a
+    cache call when they are done with it.
+    """
+
+    def __init__(self, directory, service_id, service_version="",
+                 quantum=0.001, shard_size=1800, max_bytes=10 << 30,
+                 loaded_shards=64):
+        if 648000 / quantum >= _LONG_OFFSET:
+            raise Exception("Cache quantum is too small!")
+        namespace = hashlib.sha1(
+            "{0}\0{1}".format(service_id, service_version).encode("utf-8")
+            ).hexdigest()[:16]
+        self.directory = os.path.join(directory, namespace)
+        self.quantum = quantum
+        self.shard_quanta = int(round(shard_size / quantum))
+        self.max_bytes = max_bytes
+        self.loaded_shards = loaded_shards
+        self._loaded = collections.OrderedDict()
+        self._index_changed = False
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._index_path = os.path.join(self.directory, "index.json")
+        self.index = {"service_id": service_id,
+                      "service_version": service_version,
+                      "quantum": quantum, "shard_size": shard_size,
+                      "shards": {}}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as index_file:
+                index = json.load(index_file)
+            if (index["quantum"] != quantum or
+                    index["shard_size"] != shard_size):
+                raise Exception("Cache was created with another quantum or "
+                                "shard size!")
+            self.index = index
+
+    def _keys(self, latitudes, longitudes):
+        # coordinates in arc-seconds
+        keys, lat_q, long_q = node_keys(latitudes, longitudes, self.quantum)
+        shards = (((lat_q // self.shard_quanta) << 32) +
+                  (long_q // self.shard_quanta))
+        return keys, shards
+
+    def _shard_name(self, shard):
+        shard = int(shard)
+        return "{0}_{1}".format(shard >> 32, shard - ((shard >> 32) << 32))
+
+    def _shard_paths(self, name):
+        base = os.path.join(self.directory, name)
+        return base + ".keys", base + ".values"
+
+    def _load_shard(self, name):
+        if name not in self.index["shards"]:
+            return None, None
+        if name in self._loaded:
+            self._loaded[name] = self._loaded.pop(name)
+            return self._loaded[name]
+        keys_path, values_path = self._shard_paths(name)
+        shard = (np.fromfile(keys_path, dtype="<u8"),
+                 np.fromfile(values_path, dtype=VALUE_DTYPE))
+        self._loaded[name] = shard
+        while len(self._loaded) > self.loaded_shards:
+            self._loaded.popitem(last=False)
+        return shard
+
+    def _group(self, shards):
+        order = np.argsort(shards, kind="mergesort")
+        sorted_shards = shards[order]
+        starts = np.flatnonzero(np.r_[True, sorted_shards[1:] !=
+                                      sorted_shards[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            yield self._shard_name(sorted_shards[start]), order[start:end]
+
+    def lookup(self, latitudes, longitudes):
+        """Returns (found mask, values) for nodes given in arc-seconds;
+        values is a VALUE_DTYPE array, meaningful where found is set."""
+        keys, shards = self._keys(latitudes, longitudes)
+        found = np.zeros(len(keys), dtype=bool)
+        values = np.zeros(len(keys), dtype=VALUE_DTYPE)
+        now = time.time()
+        for name, positions in self._group(shards):
+            shard_keys, shard_values = self._load_shard(name)
+            if shard_keys is None or not len(shard_keys):
+                continue
+            wanted = keys[positions]
+            slots = np.searchsorted(shard_keys, wanted)
+            slots[slots == len(shard_keys)] = 0
+            hit = shard_keys[slots] == wanted
+            found[positions[hit]] = True
+            values[positions[hit]] = shard_values[slots[hit]]
+            self.index["shards"][name]["used"] = now
+            self._index_changed = True
+        return found, values
+
+    def contains(self, latitudes, longitudes):
+        return self.lookup(latitudes, longitudes)[0]
+
+    def store(self, latitudes, longitudes, eastings, northings, shifts):
+        """Adds or replaces the entries of nodes given in arc-seconds."""
+        keys, shards = self._keys(latitudes, longitudes)
+        values = np.zeros(len(keys), dtype=VALUE_DTYPE)
+        values["easting"] = eastings
+        values["northing"] = northings
+        values["shifts"] = shifts
+        now = time.time()
+        for name, positions in self._group(shards):
+            new_keys = keys[positions]
+            new_values = values[positions]
+            old_keys, old_values = self._load_shard(name)
+            if old_keys is not None:
+                # new entries first, so that they win over stale ones
+                new_keys = np.concatenate([new_keys, old_keys])
+                new_values = np.concatenate([new_values, old_values])
+            new_keys, unique = np.unique(new_keys, return_index=True)
+            new_values = new_values[unique]
+            keys_path, values_path = self._shard_paths(name)
+            for path, data in ((keys_path, new_keys.astype("<u8")),
+                               (values_path, new_values)):
+                with open(path + ".tmp", "wb") as output:
+                    data.tofile(output)
+                os.replace(path + ".tmp", path)
+            self._loaded.pop(name, None)
+            self.index["shards"][name] = {
+                "used": now,
+                "bytes": os.path.getsize(keys_path) +
+                os.path.getsize(values_path)}
+            self._index_changed = True
+        self._evict()
+
+    def size(self):
+        return sum(shard["bytes"] for shard in self.index["shards"].values())
+
+    def _evict(self):
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+        by_age = sorted(self.index["shards"].items(),
+                        key=lambda item: item[1]["used"])
+        for name, shard in by_age:
+            if total <= self.max_bytes:
+                break
+            for path in self._shard_paths(name):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._loaded.pop(name, None)
+            total -= shard["bytes"]
+            del self.index["shards"][name]
+        # the index on disk must not list removed shards
+        self._save_index()
+
+    def flush(self):
+        """Writes the index, if it changed since it was last written."""
+        if self._index_changed:
+            self._save_index()
+
+    def close(self):
+        self.flush()
+        self._loaded.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _save_index(self):
+        with open(self._index_path + ".tmp", "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(self._index_path + ".tmp", self._index_path)
+        self._index_changed = False
@@ -0,0 +1,110 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+Streaming conversion between ASCII (.gsa) and binary (.gsb) NTv2 files.
+Grid shifts are converted in blocks, so memory use does not depend on the
+size of the files.
+"""
+
+import itertools
+import os
+
+import ntv2reader
+import ntv2writer
+
+
+def _check_output(output_path, overwrite):
+    if os.path.exists(output_path) and not overwrite:
+        raise Exception("File already exists!")
+
+
+def _header_lines(lines, count):
+    header = {}
+    for line in itertools.islice(lines, count):
+        name, value = ntv2reader._parse_ascii_record(line)
+        header[name] = value
+    if len(header) != count:
+        raise Exception("Unexpected end of file!")
+    return header
+
+
+def gsb_to_gsa(input_path, output_path, overwrite=False):
+    """Converts a binary NTv2 file to ASCII."""
+    _check_output(output_path, overwrite)
+    ntv2_file = ntv2reader.read_ntv2_file(input_path)
+    if not ntv2_file.binary_format:
+        raise Exception("{0} is not a binary NTv2 file!".format(input_path))
+    try:
+        with open(output_path, "w", 1 << 20) as output_file:
+            ntv2_file._write_header(output_file, False)
+            for subfile in ntv2_file.subfiles_dict.values():
+                # records are formatted block by block from the mapping
+                subfile.write_to_file(output_file, False)
+            ntv2_file._write_eof(output_file, False)
+    finally:
+        for subfile in ntv2_file.subfiles_dict.values():
+            subfile.clear_gridshifts()
+        ntv2_file.mmap.close()
+
+
+def gsa_to_gsb(input_path, output_path, overwrite=False,
+               block_records=ntv2writer.ASCII_BLOCK_RECORDS):
+    """Converts an ASCII NTv2 file to binary."""
+    _check_output(output_path, overwrite)
+    with open(input_path, "r") as input_file:
+        # blank separator lines are skipped everywhere
+        lines = (line for line in input_file if line.strip())
+        overview = _header_lines(lines, 11)
+        if overview.get("NUM_OREC") != 11:
+            raise Exception("{0} is not an ASCII NTv2 file!".format(
+                input_path))
+        ntv2_file = ntv2reader._build_file(overview)
+        with open(output_path, "wb") as output_file:
+            # the overview is written last, once the subfiles are known
+            ntv2_file._write_header(output_file, True)
+            for _ in range(overview["NUM_FILE"]):
+                header = _header_lines(lines, overview["NUM_SREC"])
+                subfile = ntv2reader._build_subfile(header)
+                subfile._write_header(output_file, True)
+                remaining = subfile.gs_count
+                while remaining:
+                    block = list(itertools.islice(
+                        lines, min(remaining, block_records)))
+                    records = ntv2reader._parse_ascii_records(
+                        "".join(block), subfile.name)
+                    if not block or len(records) != len(block) * 4:
+                        raise Exception(
+                            "Malformed grid shift records in subfile "
+                            "{0}!".format(subfile.name))
+                    output_file.write(records.data)
+                    remaining -= len(block)
+                ntv2_file.subfiles_dict[subfile.name] = subfile
+            ntv2_file._write_eof(output_file, True)
+            output_file.seek(0)
+            ntv2_file._write_header(output_file, True)
+
+
+def convert(input_path, output_path, overwrite=False):
+    """Converts an NTv2 file to the other format (ASCII to binary or
+    binary to ASCII), detected from its content."""
+    with open(input_path, "rb") as input_file:
+        start = input_file.read(9)
+    if start[:8] != b"NUM_OREC":
+        raise Exception("{0} is not an NTv2 file!".format(input_path))
+    if start[8:9] in (b" ", b"\t"):
+        gsa_to_gsb(input_path, output_path, overwrite)
+    else:
+        gsb_to_gsa(input_path, output_path, overwrite)
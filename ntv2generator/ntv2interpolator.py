@@ -0,0 +1,187 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+import ntv2writer
+
+
+# size of one GS_TYPE unit in arc-seconds
+UNIT_SECONDS = {"SECONDS": 1.0, "MINUTES": 60.0, "DEGREES": 3600.0}
+
+
+class NTv2Interpolator(object):
+    """Bilinear grid shift interpolation over the subfiles of an NTv2 grid.
+
+    Follows PROJ: a point is looked up in the first top-level subfile that
+    contains it, then descends into the first containing child until no
+    child contains it. Shifts are returned in arc-seconds with the
+    longitude shift positive east (NTv2 stores it positive west).
+    """
+
+    def __init__(self, grids):
+        if isinstance(grids, ntv2writer.NTv2SubFile):
+            subfiles = [grids]
+            unit = "SECONDS"
+        elif isinstance(grids, ntv2writer.NTv2File):
+            subfiles = list(grids.subfiles_dict.values())
+            unit = grids.gridshift_data_type
+        else:
+            subfiles = list(grids)
+            unit = "SECONDS"
+        if not subfiles:
+            raise Exception("No subfiles to interpolate from!")
+
+        self.subfiles = subfiles
+        self.unit_seconds = UNIT_SECONDS[unit]
+        self._grids = [subfile.grid_view() for subfile in subfiles]
+
+        # bounding box index, in GS_TYPE units with longitudes positive east
+        self._south = np.array([s.bounding_box.south for s in subfiles], float)
+        self._north = np.array([s.bounding_box.north for s in subfiles], float)
+        self._west = np.array([s.bounding_box.west for s in subfiles], float)
+        self._east = np.array([s.bounding_box.east for s in subfiles], float)
+        self._lat_inc = np.array([s.lat_increase for s in subfiles], float)
+        self._long_inc = np.array([s.long_increase for s in subfiles], float)
+
+        names = dict((s.name, idx) for idx, s in enumerate(subfiles))
+        self._children = dict((idx, []) for idx in range(-1, len(subfiles)))
+        for idx, subfile in enumerate(subfiles):
+            # grids whose parent is missing are treated as top level grids,
+            # the same way PROJ does
+            parent = names.get(subfile.parent, -1)
+            if parent == idx:
+                parent = -1
+            self._children[parent].append(idx)
+
+        self._levels = []
+        level = [-1]
+        while True:
+            parents = [p for p in level if self._children[p]]
+            if not parents:
+                break
+            self._levels.append(parents)
+            level = [c for p in parents for c in self._children[p]]
+
+    def _contains(self, grid, lon, lat):
+        return ((lon >= self._west[grid]) & (lon <= self._east[grid]) &
+                (lat >= self._south[grid]) & (lat <= self._north[grid]))
+
+    def find_subfiles(self, longitude, latitude):
+        """Returns the index of the finest subfile containing each point
+        (-1 where no subfile does); coordinates are in decimal degrees."""
+        lon, lat = self._to_grid_units(longitude, latitude)
+        return self._assign(lon, lat)
+
+    def _to_grid_units(self, longitude, latitude):
+        scale = 3600.0 / self.unit_seconds
+        lon = np.asarray(longitude, dtype=float).ravel() * scale
+        lat = np.asarray(latitude, dtype=float).ravel() * scale
+        if lon.shape != lat.shape:
+            raise Exception("Longitude and latitude arrays differ in size!")
+        return lon, lat
+
+    def _assign(self, lon, lat):
+        assigned = np.full(len(lon), -1, dtype=np.intp)
+        for parents in self._levels:
+            order = np.argsort(assigned, kind="mergesort")
+            sorted_assigned = assigned[order]
+            for parent in parents:
+                start = np.searchsorted(sorted_assigned, parent, "left")
+                end = np.searchsorted(sorted_assigned, parent, "right")
+                candidates = order[start:end]
+                for child in self._children[parent]:
+                    if not len(candidates):
+                        break
+                    inside = self._contains(child, lon[candidates],
+                                            lat[candidates])
+                    assigned[candidates[inside]] = child
+                    candidates = candidates[~inside]
+        return assigned
+
+    def _interpolate_grid(self, grid, lon, lat):
+        data = self._grids[grid]
+        rows, cols = data.shape[:2]
+        x = (lon - self._west[grid]) / self._long_inc[grid]
+        y = (lat - self._south[grid]) / self._lat_inc[grid]
+        ix = np.floor(x).astype(np.intp)
+        iy = np.floor(y).astype(np.intp)
+        fx = x - ix
+        fy = y - iy
+
+        # same edge tolerances as PROJ's pj_hgrid_interpolate
+        fix = (ix == -1) & (fx > 0.99999999999)
+        ix[fix] += 1
+        fx[fix] = 0.0
+        fix = (ix + 1 == cols) & (fx < 1e-11)
+        ix[fix] -= 1
+        fx[fix] = 1.0
+        fix = (iy == -1) & (fy > 0.99999999999)
+        iy[fix] += 1
+        fy[fix] = 0.0
+        fix = (iy + 1 == rows) & (fy < 1e-11)
+        iy[fix] -= 1
+        fy[fix] = 1.0
+        valid = (ix >= 0) & (ix + 1 < cols) & (iy >= 0) & (iy + 1 < rows)
+        ix = np.where(valid, ix, 0)
+        iy = np.where(valid, iy, 0)
+
+        # records in a row are stored from east to west
+        col0 = cols - 1 - ix
+        col1 = np.maximum(col0 - 1, 0)
+        row1 = np.minimum(iy + 1, rows - 1)
+        m00 = (1.0 - fx) * (1.0 - fy)
+        m10 = fx * (1.0 - fy)
+        m01 = (1.0 - fx) * fy
+        m11 = fx * fy
+        shifts = (m00[:, None] * data[iy, col0, :2] +
+                  m10[:, None] * data[iy, col1, :2] +
+                  m01[:, None] * data[row1, col0, :2] +
+                  m11[:, None] * data[row1, col1, :2])
+        shifts[~valid] = np.nan
+        return shifts
+
+    def interpolate(self, longitude, latitude):
+        """Returns the (latitude, longitude) shifts in arc-seconds for points
+        given in decimal degrees; NaN for points outside the grid."""
+        lon, lat = self._to_grid_units(longitude, latitude)
+        assigned = self._assign(lon, lat)
+        lat_shift = np.full(len(lon), np.nan)
+        long_shift = np.full(len(lon), np.nan)
+
+        order = np.argsort(assigned, kind="mergesort")
+        sorted_assigned = assigned[order]
+        bounds = np.searchsorted(sorted_assigned,
+                                 np.arange(len(self.subfiles) + 1), "left")
+        for grid in range(len(self.subfiles)):
+            points = order[bounds[grid]:bounds[grid + 1]]
+            if not len(points):
+                continue
+            shifts = self._interpolate_grid(grid, lon[points], lat[points])
+            lat_shift[points] = shifts[:, 0]
+            long_shift[points] = -shifts[:, 1]
+
+        lat_shift *= self.unit_seconds
+        long_shift *= self.unit_seconds
+        shape = np.shape(latitude)
+        return lat_shift.reshape(shape), long_shift.reshape(shape)
+
+    def transform(self, longitude, latitude):
+        """Applies the grid shifts to points given in decimal degrees."""
+        lat_shift, long_shift = self.interpolate(longitude, latitude)
+        return (np.asarray(longitude, dtype=float) + long_shift / 3600.0,
+                np.asarray(latitude, dtype=float) + lat_shift / 3600.0)
@@ -0,0 +1,275 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+In-place updates of the grid shifts of a region in a binary NTv2 file.
+"""
+
+import datetime
+import hashlib
+import math
+import os
+import shutil
+import struct
+
+import numpy as np
+
+import ntv2reader
+import ntv2writer
+
+
+JOURNAL_SUFFIX = ".journal"
+
+_JOURNAL_MAGIC = b"NTV2JRNL"
+_SEGMENT_FORMAT = "<qqqq"
+# nodes closer than this (in cells) to the region limits are inside it
+_NODE_TOLERANCE = 1e-6
+
+
+class PatchRegion(object):
+    """Nodes of a subfile inside a bounding box: rows row_start..row_end
+    (south to north) and columns col_start..col_end (east to west)."""
+
+    def __init__(self, subfile, row_start, row_end, col_start, col_end):
+        self.subfile = subfile
+        self.row_start = row_start
+        self.row_end = row_end
+        self.col_start = col_start
+        self.col_end = col_end
+
+    @property
+    def shape(self):
+        return (self.row_end - self.row_start + 1,
+                self.col_end - self.col_start + 1)
+
+
+def _node_range(low, high, origin, increment, count):
+    # indices of the nodes origin + i*increment between low and high
+    start = max(0, int(math.ceil((low - origin) / increment -
+                                 _NODE_TOLERANCE)))
+    end = min(count - 1, int(math.floor((high - origin) / increment +
+                                        _NODE_TOLERANCE)))
+    return start, end
+
+
+def locate_region(ntv2_file, bounding_box, subfile_name=None):
+    """Finds the nodes of a subfile inside bounding_box (in the units of
+    the file). Without a subfile name, the subfile with the finest
+    spacing covering the whole box is used."""
+    if subfile_name is not None:
+        if subfile_name not in ntv2_file.subfiles_dict:
+            raise Exception(
+                "Subfile {0} does not exist!".format(subfile_name))
+        subfile = ntv2_file.subfiles_dict[subfile_name]
+    else:
+        candidates = [
+            subfile for subfile in ntv2_file.subfiles_dict.values()
+            if subfile.bounding_box.south <= bounding_box.south and
+            subfile.bounding_box.north >= bounding_box.north and
+            subfile.bounding_box.west <= bounding_box.west and
+            subfile.bounding_box.east >= bounding_box.east]
+        if not candidates:
+            raise Exception("No subfile covers the region!")
+        subfile = min(candidates,
+                      key=lambda item: item.lat_increase * item.long_increase)
+
+    limits = subfile.bounding_box
+    row_start, row_end = _node_range(bounding_box.south, bounding_box.north,
+                                     limits.south, subfile.lat_increase,
+                                     subfile.row_count)
+    # columns are numbered from the east
+    col_start, col_end = _node_range(limits.east - bounding_box.east,
+                                     limits.east - bounding_box.west,
+                                     0.0, subfile.long_increase,
+                                     subfile.col_count)
+    if row_start > row_end or col_start > col_end:
+        raise Exception(
+            "The region contains no node of subfile {0}!".format(subfile.name))
+    return PatchRegion(subfile, row_start, row_end, col_start, col_end)
+
+
+def _updated_offset(ntv2_file, subfile):
+    data = ntv2_file.mmap
+    offset = subfile.header_offset
+    for _ in range(11):
+        if data[offset:offset + 8].rstrip() == b"UPDATED":
+            return offset
+        offset += ntv2reader.HEADER_RECORD_SIZE
+    raise Exception(
+        "Subfile {0} has no UPDATED header field!".format(subfile.name))
+
+
+def _fsync_directory(path):
+    if os.name != "posix":
+        return
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def _write_journal(journal_path, data, segments):
+    # segments are (offset, stride, count, length) blocks of the file;
+    # their current content is saved, followed by a checksum of the whole
+    # journal so that a partially written journal is never replayed
+    content = [_JOURNAL_MAGIC, struct.pack("<qq", len(data), len(segments))]
+    for segment in segments:
+        content.append(struct.pack(_SEGMENT_FORMAT, *segment))
+    for offset, stride, count, length in segments:
+        for i in range(count):
+            start = offset + i * stride
+            content.append(data[start:start + length])
+    content = b"".join(content)
+    with open(journal_path, "wb") as journal:
+        journal.write(content)
+        journal.write(hashlib.sha1(content).digest())
+        journal.flush()
+        os.fsync(journal.fileno())
+    _fsync_directory(journal_path)
+
+
+def recover(file_name):
+    """Rolls back an interrupted journaled patch of file_name. Returns
+    True if the file was restored from its journal."""
+    journal_path = file_name + JOURNAL_SUFFIX
+    if not os.path.exists(journal_path):
+        return False
+    with open(journal_path, "rb") as journal:
+        content = journal.read()
+    body, digest = content[:-20], content[-20:]
+    restored = False
+    if (body[:8] == _JOURNAL_MAGIC and
+            hashlib.sha1(body).digest() == digest):
+        file_size, segment_count = struct.unpack("<qq", body[8:24])
+        position = 24
+        segment_size = struct.calcsize(_SEGMENT_FORMAT)
+        segments = []
+        for _ in range(segment_count):
+            segments.append(struct.unpack(
+                _SEGMENT_FORMAT, body[position:position + segment_size]))
+            position += segment_size
+        with open(file_name, "r+b") as output_file:
+            output_file.seek(0, os.SEEK_END)
+            if output_file.tell() != file_size:
+                raise Exception(
+                    "{0} changed size since it was journaled!".format(
+                        file_name))
+            for offset, stride, count, length in segments:
+                for i in range(count):
+                    output_file.seek(offset + i * stride)
+                    output_file.write(body[position:position + length])
+                    position += length
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        restored = True
+    # an incomplete journal means the file itself was never modified
+    os.remove(journal_path)
+    _fsync_directory(journal_path)
+    return restored
+
+
+def _apply(ntv2_file, region, gridshifts, update_date, journal_path=None):
+    subfile = region.subfile
+    data = ntv2_file.mmap
+    record_size = ntv2writer.RECORD_SIZE
+    row_bytes = subfile.col_count * record_size
+    updated_offset = _updated_offset(ntv2_file, subfile)
+    segments = [
+        (subfile.records_offset + region.row_start * row_bytes +
+         region.col_start * record_size, row_bytes, region.shape[0],
+         region.shape[1] * record_size),
+        (updated_offset, 0, 1, ntv2reader.HEADER_RECORD_SIZE)]
+    if journal_path is not None:
+        _write_journal(journal_path, data, segments)
+
+    records = np.frombuffer(data, dtype=ntv2_file.byte_order + "f4",
+                            count=subfile.gs_count * 4,
+                            offset=subfile.records_offset)
+    grid = records.reshape(subfile.row_count, subfile.col_count, 4)
+    grid[region.row_start:region.row_end + 1,
+         region.col_start:region.col_end + 1] = gridshifts
+    del records, grid
+    data[updated_offset:updated_offset + ntv2reader.HEADER_RECORD_SIZE] = (
+        ntv2writer._format_ntv2_record("UPDATED ",
+                                       ntv2writer._format_date(update_date),
+                                       "s", True))
+    data.flush()
+
+
+def patch_region(file_name, bounding_box, gridshifts, subfile_name=None,
+                 update_date=None, mode="journal"):
+    """Overwrites the grid shifts of the nodes inside bounding_box in an
+    existing binary NTv2 file and sets the UPDATED field of the subfile.
+
+    gridshifts holds the new records of the region (see locate_region),
+    rows from south to north and columns from east to west, as
+    NTv2SubFile.grid_view. In "journal" mode the file is changed in place
+    through a memory map, after saving the overwritten bytes to a journal
+    which recover() (called first on every patch) uses to roll back an
+    interrupted update; the cost only depends on the region size. In
+    "swap" mode a patched copy replaces the file, which costs a full copy.
+
+    Returns the PatchRegion that was updated.
+    """
+    if mode not in ("journal", "swap"):
+        raise Exception("Unknown patch mode: {0}".format(mode))
+    if update_date is None:
+        update_date = datetime.datetime.now()
+    recover(file_name)
+
+    if mode == "journal":
+        target_name = file_name
+        journal_path = file_name + JOURNAL_SUFFIX
+    else:
+        target_name = file_name + ".tmp"
+        journal_path = None
+        shutil.copyfile(file_name, target_name)
+    ntv2_file = None
+    try:
+        ntv2_file = ntv2reader.read_ntv2_file(target_name, writable=True)
+        # the subfiles hold views into the mapping, which could not be
+        # closed while they exist
+        for subfile in ntv2_file.subfiles_dict.values():
+            subfile.clear_gridshifts()
+        if not ntv2_file.binary_format:
+            raise Exception("Only binary NTv2 files can be patched!")
+        region = locate_region(ntv2_file, bounding_box, subfile_name)
+        gridshifts = np.asarray(gridshifts, dtype=ntv2writer.RECORD_DTYPE)
+        if gridshifts.size != region.shape[0] * region.shape[1] * 4:
+            raise Exception(
+                "The region has {0}x{1} nodes, got {2} grid shift "
+                "values!".format(region.shape[0], region.shape[1],
+                                 gridshifts.size))
+        gridshifts = gridshifts.reshape(region.shape + (4,))
+        _apply(ntv2_file, region, gridshifts, update_date, journal_path)
+    except Exception:
+        if ntv2_file is not None and getattr(ntv2_file, "mmap", None):
+            ntv2_file.mmap.close()
+        if mode == "journal":
+            recover(file_name)
+        else:
+            os.remove(target_name)
+        raise
+    ntv2_file.mmap.close()
+
+    if mode == "journal":
+        os.remove(journal_path)
+    else:
+        with open(target_name, "r+b") as output_file:
+            os.fsync(output_file.fileno())
+        os.replace(target_name, file_name)
+    _fsync_directory(file_name)
+    return region
@@ -0,0 +1,236 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import mmap
+import struct
+import warnings
+
+import numpy as np
+
+import ntv2writer
+
+
+HEADER_RECORD_SIZE = 16
+
+_INT_FIELDS = ["NUM_OREC", "NUM_SREC", "NUM_FILE", "GS_COUNT"]
+_STRING_FIELDS = ["GS_TYPE", "VERSION", "SYSTEM_F", "SYSTEM_T",
+                  "SUB_NAME", "PARENT", "CREATED", "UPDATED"]
+
+
+def _decode_str(value):
+    return value.decode("ascii", "replace").rstrip(" \x00")
+
+
+def _parse_binary_record(data, offset, byte_order):
+    name = _decode_str(data[offset:offset + 8]).strip()
+    raw_value = data[offset + 8:offset + HEADER_RECORD_SIZE]
+    if name in _INT_FIELDS:
+        value = struct.unpack(byte_order + "i", raw_value[:4])[0]
+    elif name in _STRING_FIELDS:
+        value = _decode_str(raw_value)
+    else:
+        value = struct.unpack(byte_order + "d", raw_value)[0]
+    return name, value
+
+
+def _parse_ascii_record(line):
+    fields = line.split(None, 1)
+    if not fields:
+        raise Exception("Unexpected empty header line!")
+    name = fields[0]
+    value = fields[1].strip() if len(fields) > 1 else ""
+    if name in _INT_FIELDS:
+        value = int(value)
+    elif name not in _STRING_FIELDS:
+        value = float(value)
+    return name, value
+
+
+def _parse_ascii_records(text, name):
+    # whitespace separated values, parsed in C rather than value by value
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            values = np.fromstring(text, dtype=np.float64, sep=" ")
+        except (ValueError, DeprecationWarning):
+            raise Exception(
+                "Malformed grid shift records in subfile {0}!".format(name)
+                )
+    return values.astype(ntv2writer.RECORD_DTYPE)
+
+
+def _build_file(overview):
+    ntv2_file = ntv2writer.NTv2File(overview["GS_TYPE"].strip())
+    ntv2_file.set_ref_systems(
+        ntv2writer.CRSDef(overview["SYSTEM_F"],
+                          overview["MAJOR_F"], overview["MINOR_F"]),
+        ntv2writer.CRSDef(overview["SYSTEM_T"],
+                          overview["MAJOR_T"], overview["MINOR_T"])
+        )
+    return ntv2_file
+
+
+def _build_subfile(header):
+    subfile = ntv2writer.NTv2SubFile(header["SUB_NAME"], header["PARENT"])
+    # NTv2 stores longitudes positive west
+    subfile.set_limits(ntv2writer.BoundingBox(header["N_LAT"],
+                                              header["S_LAT"],
+                                              -header["W_LONG"],
+                                              -header["E_LONG"]))
+    # header values are floats read back from disk (rounded to a few
+    # decimals in ASCII files), so round rather than truncate when
+    # recovering the node counts
+    subfile.set_coord_increment(
+        header["LAT_INC"], header["LONG_INC"],
+        counts=(int(round((header["N_LAT"] - header["S_LAT"]) /
+                          header["LAT_INC"])) + 1,
+                int(round((header["W_LONG"] - header["E_LONG"]) /
+                          header["LONG_INC"])) + 1))
+    if subfile.gs_count != header["GS_COUNT"]:
+        raise Exception(
+            "Subfile {0} declares {1} grid shifts, but its limits and "
+            "increments describe {2}x{3} nodes!".format(
+                subfile.name, header["GS_COUNT"],
+                subfile.row_count, subfile.col_count)
+            )
+    subfile.set_dates(ntv2writer._parse_date(header["CREATED"]),
+                      ntv2writer._parse_date(header["UPDATED"]))
+    return subfile
+
+
+def _read_binary(data):
+    if struct.unpack("<i", data[8:12])[0] == 11:
+        byte_order = "<"
+    elif struct.unpack(">i", data[8:12])[0] == 11:
+        byte_order = ">"
+    else:
+        raise Exception("Unable to determine the byte order of the file!")
+    record_dtype = np.dtype(byte_order + "f4")
+
+    offset = 0
+    overview = {}
+    num_orec = struct.unpack(byte_order + "i", data[8:12])[0]
+    for _ in range(num_orec):
+        name, value = _parse_binary_record(data, offset, byte_order)
+        overview[name] = value
+        offset += HEADER_RECORD_SIZE
+    ntv2_file = _build_file(overview)
+    ntv2_file.byte_order = byte_order
+
+    for _ in range(overview["NUM_FILE"]):
+        header = {}
+        header_offset = offset
+        for _ in range(overview["NUM_SREC"]):
+            name, value = _parse_binary_record(data, offset, byte_order)
+            header[name] = value
+            offset += HEADER_RECORD_SIZE
+        subfile = _build_subfile(header)
+        records_size = subfile.gs_count * ntv2writer.RECORD_SIZE
+        if offset + records_size > len(data):
+            raise Exception(
+                "File is truncated inside subfile {0}!".format(subfile.name)
+                )
+        records = np.frombuffer(data, dtype=record_dtype,
+                                count=subfile.gs_count * 4,
+                                offset=offset).reshape(-1, 4)
+        if record_dtype == ntv2writer.RECORD_DTYPE:
+            subfile.set_gridshifts(records)
+        else:
+            # grid shifts are held little-endian, so big-endian files are
+            # converted, and read, in full here
+            subfile.set_gridshifts(records.astype(ntv2writer.RECORD_DTYPE))
+        subfile.header_offset = header_offset
+        subfile.records_offset = offset
+        offset += records_size
+        ntv2_file.subfiles_dict[subfile.name] = subfile
+    return ntv2_file
+
+
+def _read_ascii(data):
+    lines = data.decode("ascii").splitlines()
+    line_idx = [0]
+
+    def next_line():
+        # skips the blank separator lines written between blocks
+        while line_idx[0] < len(lines) and not lines[line_idx[0]].strip():
+            line_idx[0] += 1
+        if line_idx[0] >= len(lines):
+            raise Exception("Unexpected end of file!")
+        line = lines[line_idx[0]]
+        line_idx[0] += 1
+        return line
+
+    overview = {}
+    name, value = _parse_ascii_record(next_line())
+    overview[name] = value
+    for _ in range(overview["NUM_OREC"] - 1):
+        name, value = _parse_ascii_record(next_line())
+        overview[name] = value
+    ntv2_file = _build_file(overview)
+
+    for _ in range(overview["NUM_FILE"]):
+        header = {}
+        for _ in range(overview["NUM_SREC"]):
+            name, value = _parse_ascii_record(next_line())
+            header[name] = value
+        subfile = _build_subfile(header)
+        next_line()
+        start = line_idx[0] - 1
+        end = start + subfile.gs_count
+        if end > len(lines):
+            raise Exception(
+                "File is truncated inside subfile {0}!".format(subfile.name)
+                )
+        records = _parse_ascii_records("\n".join(lines[start:end]),
+                                       subfile.name)
+        if len(records) != subfile.gs_count * 4:
+            raise Exception(
+                "Malformed grid shift records in subfile {0}!".format(
+                    subfile.name)
+                )
+        subfile.set_gridshifts(records)
+        line_idx[0] = end
+        ntv2_file.subfiles_dict[subfile.name] = subfile
+    return ntv2_file
+
+
+def read_ntv2_file(file_name, writable=False):
+    """Loads an NTv2 file written in binary or ASCII format.
+
+    Binary files are memory mapped: only the headers are parsed and the
+    grid shifts of every subfile are views into the mapping, so record
+    data is read from disk only when it is accessed. Big-endian binary
+    files are the exception: their grid shifts are converted to
+    little-endian, and so read in full, when the file is loaded.
+    """
+    with open(file_name, "r+b" if writable else "rb") as input_file:
+        data = mmap.mmap(input_file.fileno(), 0,
+                         access=mmap.ACCESS_WRITE if writable
+                         else mmap.ACCESS_READ)
+    if data[:8] != b"NUM_OREC":
+        raise Exception("{0} is not an NTv2 file!".format(file_name))
+
+    if data[8:9] in (b" ", b"\t"):
+        ntv2_file = _read_ascii(data[:])
+        ntv2_file.binary_format = False
+        data.close()
+    else:
+        ntv2_file = _read_binary(data)
+        ntv2_file.binary_format = True
+        ntv2_file.mmap = data
+    ntv2_file.file_name = file_name
+    return ntv2_file
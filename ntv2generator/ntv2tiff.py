@@ -0,0 +1,572 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+Tiled, DEFLATE compressed GeoTIFF export of NTv2 files, following the
+GeoTIFF grid (GTG) conventions PROJ reads, and a reader decompressing only
+the tiles covering a region.
+
+Every subfile becomes one image of the TIFF file, parents first, with its
+four NTv2 values as separate float32 bands (latitude_offset,
+longitude_offset and their accuracies). Rows go from north to south and
+columns from west to east, as in any GeoTIFF; longitude offsets keep the
+NTv2 sign, declared by positive_value=west. The NTv2 header values are
+kept in the GDAL metadata, so that the file converts back to the exact
+same NTv2 file.
+"""
+
+import collections
+import multiprocessing
+import os
+import struct
+import xml.etree.ElementTree as ElementTree
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+import instrumentation
+import ntv2patch
+import ntv2writer
+
+
+TILE_SIZE = 256
+
+_BANDS = ("latitude_offset", "longitude_offset", "latitude_offset_accuracy",
+          "longitude_offset_accuracy")
+_UNITS = {"SECONDS": ("arc-second", 3600.0),
+          "MINUTES": ("arc-minute", 60.0),
+          "DEGREES": ("degree", 1.0)}
+
+# TIFF tags and field types
+_NEW_SUBFILE_TYPE = 254
+_IMAGE_WIDTH = 256
+_IMAGE_LENGTH = 257
+_BITS_PER_SAMPLE = 258
+_COMPRESSION = 259
+_PHOTOMETRIC = 262
+_SAMPLES_PER_PIXEL = 277
+_PLANAR_CONFIGURATION = 284
+_PREDICTOR = 317
+_TILE_WIDTH = 322
+_TILE_LENGTH = 323
+_TILE_OFFSETS = 324
+_TILE_BYTE_COUNTS = 325
+_EXTRA_SAMPLES = 338
+_SAMPLE_FORMAT = 339
+_MODEL_PIXEL_SCALE = 33550
+_MODEL_TIEPOINT = 33922
+_GEO_KEY_DIRECTORY = 34735
+_GEO_DOUBLE_PARAMS = 34736
+_GEO_ASCII_PARAMS = 34737
+_GDAL_METADATA = 42112
+
+_TYPES = {"s": 2, "H": 3, "I": 4, "d": 12, "Q": 16}
+_TYPE_FORMATS = {1: "B", 2: "s", 3: "H", 4: "I", 12: "d", 16: "Q"}
+
+_DEFLATE = 8
+_FLOATING_POINT_PREDICTOR = 3
+
+
+def _encode_tile(tile, predictor, level):
+    # with the floating point predictor, the bytes of every row are sorted
+    # by significance (most significant first) and differenced
+    if predictor:
+        rows, cols = tile.shape
+        data = tile.astype(">f4").view(np.uint8).reshape(rows, cols, 4)
+        data = data.transpose(0, 2, 1).reshape(rows, cols * 4)
+        data[:, 1:] = np.diff(data, axis=1)
+    else:
+        data = tile.astype("<f4")
+    return zlib.compress(data.tobytes(), level)
+
+
+def _decode_tile(data, predictor, tile_length, tile_width):
+    data = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    if not predictor:
+        return data.view("<f4").reshape(tile_length, tile_width)
+    data = np.cumsum(data.reshape(tile_length, tile_width * 4), axis=1,
+                     dtype=np.uint8)
+    data = data.reshape(tile_length, 4, tile_width).transpose(0, 2, 1)
+    return np.ascontiguousarray(data).view(">f4")[:, :, 0]
+
+
+def _metadata(items):
+    # GDAL_METADATA content: (name, sample, role, value) items
+    lines = ["<GDALMetadata>"]
+    for name, sample, role, value in items:
+        attributes = ' name="{0}"'.format(escape(name))
+        if sample is not None:
+            attributes += ' sample="{0}"'.format(sample)
+        if role is not None:
+            attributes += ' role="{0}"'.format(role)
+        lines.append("  <Item{0}>{1}</Item>".format(attributes,
+                                                    escape(str(value))))
+    lines.append("</GDALMetadata>")
+    return "\n".join(lines)
+
+
+def _parse_metadata(text):
+    items = {}
+    for item in ElementTree.fromstring(text).findall("Item"):
+        items[(item.get("name"), item.get("sample"))] = item.text or ""
+    return items
+
+
+class _TIFFWriter(object):
+    # writes images one after the other, each image directory following
+    # its tiles, and links every directory to the previous one
+
+    def __init__(self, output_file, bigtiff):
+        self.output_file = output_file
+        self.bigtiff = bigtiff
+        if bigtiff:
+            output_file.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+            self.next_pointer = 8
+        else:
+            output_file.write(b"II" + struct.pack("<HI", 42, 0))
+            self.next_pointer = 4
+
+    def tell(self):
+        return self.output_file.tell()
+
+    def write(self, data):
+        offset = self.output_file.tell()
+        if not self.bigtiff and offset + len(data) >= 1 << 32:
+            raise Exception(
+                "The file is too large for TIFF, use bigtiff=True!")
+        self.output_file.write(data)
+        return offset
+
+    def write_directory(self, entries):
+        """entries are (tag, format, values) with format one of _TYPES."""
+        entry_format, count_format, inline = (
+            ("<HHQ", "<Q", 8) if self.bigtiff else ("<HHI", "<H", 4))
+        pointer_format = "<Q" if self.bigtiff else "<I"
+        entries = sorted(entries)
+        # directories start on a word boundary
+        if self.tell() % 2:
+            self.write(b"\0")
+        offset = self.tell()
+        size = (struct.calcsize(count_format) +
+                len(entries) * (struct.calcsize(entry_format) + inline) +
+                inline)
+        directory = [struct.pack(count_format, len(entries))]
+        external = []
+        external_offset = offset + size
+        for tag, value_format, values in entries:
+            if value_format == "s":
+                data = values.encode("ascii") + b"\0"
+                count = len(data)
+            else:
+                count = len(values)
+                data = struct.pack("<{0}{1}".format(count, value_format),
+                                   *values)
+            if len(data) <= inline:
+                value = data.ljust(inline, b"\0")
+            else:
+                value = struct.pack(pointer_format, external_offset)
+                data += b"\0" * (len(data) % 2)
+                external.append(data)
+                external_offset += len(data)
+            directory.append(struct.pack(entry_format, tag,
+                                         _TYPES[value_format], count) +
+                             value)
+        directory.append(struct.pack(pointer_format, 0))
+        self.write(b"".join(directory + external))
+        # link the previous directory (or the header) to this one
+        end = self.tell()
+        self.output_file.seek(self.next_pointer)
+        self.output_file.write(struct.pack(pointer_format, offset))
+        self.output_file.seek(end)
+        self.next_pointer = offset + size - inline
+
+
+def _geo_keys(ntv2_file):
+    # geographic source CRS with its own ellipsoid, coordinates of the
+    # nodes at the pixel centres (PixelIsPoint)
+    name = ntv2_file.crs_from.name.strip()
+    keys = [(1024, 0, 1, 2),                         # model type geographic
+            (1025, 0, 1, 2),                         # raster is point
+            (2048, 0, 1, 32767),                     # user-defined GCS
+            (2049, _GEO_ASCII_PARAMS, len(name) + 1, 0),
+            (2050, 0, 1, 32767),                     # user-defined datum
+            (2054, 0, 1, 9102),                      # angular unit degree
+            (2056, 0, 1, 32767),                     # user-defined ellipsoid
+            (2057, _GEO_DOUBLE_PARAMS, 1, 0),
+            (2058, _GEO_DOUBLE_PARAMS, 1, 1)]
+    directory = [1, 1, 0, len(keys)]
+    for key in keys:
+        directory.extend(key)
+    doubles = [float(ntv2_file.crs_from.major_axis),
+               float(ntv2_file.crs_from.minor_axis)]
+    return directory, doubles, name + "|"
+
+
+def _subfile_items(ntv2_file, subfile, first, accuracy_unit):
+    unit = _UNITS[ntv2_file.gridshift_data_type][0]
+    items = [("grid_name", None, None, subfile.name.strip()),
+             ("TYPE", None, None, "HORIZONTAL_OFFSET")]
+    if subfile.parent.strip() != "NONE":
+        items.append(("parent_grid_name", None, None,
+                      subfile.parent.strip()))
+    for sample, band in enumerate(_BANDS):
+        items.append(("DESCRIPTION", sample, "description", band))
+    items.append(("positive_value", 1, None, "west"))
+    items.append(("UNITTYPE", 0, "unittype", unit))
+    items.append(("UNITTYPE", 1, "unittype", unit))
+    if accuracy_unit is not None:
+        items.append(("UNITTYPE", 2, "unittype", accuracy_unit))
+        items.append(("UNITTYPE", 3, "unittype", accuracy_unit))
+    # NTv2 header values, to convert back without any rounding
+    limits = subfile.bounding_box
+    items.extend([
+        ("NTV2_SUB_NAME", None, None, subfile.name),
+        ("NTV2_PARENT", None, None, subfile.parent),
+        ("NTV2_CREATED", None, None,
+         ntv2writer._format_date(subfile.date_created)),
+        ("NTV2_UPDATED", None, None,
+         ntv2writer._format_date(subfile.date_updated)),
+        ("NTV2_LIMITS", None, None, " ".join(repr(float(value)) for value in (
+            limits.north, limits.south, limits.west, limits.east,
+            subfile.lat_increase, subfile.long_increase))),
+        ("NTV2_SIZE", None, None, "{0} {1}".format(subfile.row_count,
+                                                   subfile.col_count))])
+    if first:
+        items.extend([
+            ("NTV2_GS_TYPE", None, None, ntv2_file.gridshift_data_type),
+            ("NTV2_SYSTEM_F", None, None, ntv2_file.crs_from.name),
+            ("NTV2_SYSTEM_T", None, None, ntv2_file.crs_to.name),
+            ("NTV2_AXES", None, None, " ".join(repr(float(value)) for value in (
+                ntv2_file.crs_from.major_axis, ntv2_file.crs_from.minor_axis,
+                ntv2_file.crs_to.major_axis, ntv2_file.crs_to.minor_axis)))])
+    return items
+
+
+def _write_subfile(writer, ntv2_file, subfile, first, tile_size, level,
+                   predictor, pool, accuracy_unit):
+    subfile._check_complete()
+    rows, cols = subfile.row_count, subfile.col_count
+    tiles_down = -(-rows // tile_size)
+    tiles_across = -(-cols // tile_size)
+    tile_count = tiles_down * tiles_across
+    offsets = [0] * (4 * tile_count)
+    byte_counts = [0] * (4 * tile_count)
+    band = np.zeros((tile_size, tiles_across * tile_size, 4),
+                    ntv2writer.RECORD_DTYPE)
+    for tile_row in range(tiles_down):
+        # the TIFF rows of this band of tiles, from the north
+        top = tile_row * tile_size
+        bottom = min(top + tile_size, rows)
+        start = (rows - bottom) * cols
+        end = (rows - top) * cols
+        records = np.empty((end - start, 4), ntv2writer.RECORD_DTYPE)
+        subfile._fill_records(records, start, end)
+        band[:] = 0
+        band[:bottom - top, :cols] = records.reshape(
+            bottom - top, cols, 4)[::-1, ::-1]
+        tiles = [np.ascontiguousarray(
+            band[:, tile_col * tile_size:(tile_col + 1) * tile_size, value])
+            for value in range(4) for tile_col in range(tiles_across)]
+        compressed = pool.map(
+            lambda tile: _encode_tile(tile, predictor, level), tiles)
+        for index, data in enumerate(compressed):
+            value, tile_col = divmod(index, tiles_across)
+            tile = value * tile_count + tile_row * tiles_across + tile_col
+            offsets[tile] = writer.write(data)
+            byte_counts[tile] = len(data)
+
+    unit, factor = _UNITS[ntv2_file.gridshift_data_type]
+    limits = subfile.bounding_box
+    geo_keys, geo_doubles, geo_ascii = _geo_keys(ntv2_file)
+    offset_format = "Q" if writer.bigtiff else "I"
+    entries = [
+        (_NEW_SUBFILE_TYPE, "I", [0]),
+        (_IMAGE_WIDTH, "I", [cols]),
+        (_IMAGE_LENGTH, "I", [rows]),
+        (_BITS_PER_SAMPLE, "H", [32] * 4),
+        (_COMPRESSION, "H", [_DEFLATE]),
+        (_PHOTOMETRIC, "H", [1]),
+        (_SAMPLES_PER_PIXEL, "H", [4]),
+        (_PLANAR_CONFIGURATION, "H", [2]),
+        (_PREDICTOR, "H", [_FLOATING_POINT_PREDICTOR if predictor else 1]),
+        (_TILE_WIDTH, "H", [tile_size]),
+        (_TILE_LENGTH, "H", [tile_size]),
+        (_TILE_OFFSETS, offset_format, offsets),
+        (_TILE_BYTE_COUNTS, offset_format, byte_counts),
+        (_EXTRA_SAMPLES, "H", [0] * 3),
+        (_SAMPLE_FORMAT, "H", [3] * 4),
+        (_MODEL_PIXEL_SCALE, "d", [subfile.long_increase / factor,
+                                   subfile.lat_increase / factor, 0.0]),
+        # the north-west node
+        (_MODEL_TIEPOINT, "d", [0.0, 0.0, 0.0, limits.west / factor,
+                                limits.north / factor, 0.0]),
+        (_GEO_KEY_DIRECTORY, "H", geo_keys),
+        (_GEO_DOUBLE_PARAMS, "d", geo_doubles),
+        (_GEO_ASCII_PARAMS, "s", geo_ascii),
+        (_GDAL_METADATA, "s", _metadata(
+            _subfile_items(ntv2_file, subfile, first, accuracy_unit)))]
+    writer.write_directory(entries)
+
+
+def write_geotiff(ntv2_file, file_path, overwrite=False, tile_size=TILE_SIZE,
+                  level=6, predictor=True, workers=None, bigtiff=None,
+                  accuracy_unit=None):
+    """Writes an NTv2File as a tiled GeoTIFF grid (see the module
+    documentation).
+
+    Tiles are tile_size nodes wide (a multiple of 16) and compressed with
+    DEFLATE at level, after the floating point predictor when predictor is
+    set, by workers threads (None for all cores). bigtiff defaults to
+    BigTIFF only when the file could exceed 4 GB. accuracy_unit (such as
+    "metre" or "arc-second") declares the unit of the accuracies, which
+    NTv2 leaves undefined.
+    """
+    if os.path.exists(file_path) and not overwrite:
+        raise Exception("File already exists!")
+    if tile_size < 16 or tile_size % 16:
+        raise Exception("The tile size has to be a multiple of 16!")
+    if not ntv2_file.has_overview:
+        raise Exception("No overview file defined!")
+    if bigtiff is None:
+        # uncompressed size, plus what DEFLATE adds in the worst case
+        total = sum(-(-subfile.row_count // tile_size) * tile_size *
+                    -(-subfile.col_count // tile_size) * tile_size
+                    for subfile in ntv2_file.subfiles_dict.values())
+        bigtiff = total * ntv2writer.RECORD_SIZE * 1.01 >= (1 << 32) - (1 << 24)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    total = sum(subfile.gs_count
+                for subfile in ntv2_file.subfiles_dict.values())
+    stage = instrumentation.current().stage(
+        "write_geotiff", total=total, file=file_path, bigtiff=bigtiff)
+    pool = ThreadPoolExecutor(max(1, workers))
+    try:
+        with stage, open(file_path, "wb") as output_file:
+            writer = _TIFFWriter(output_file, bigtiff)
+            done = 0
+            for index, subfile in enumerate(ntv2_file.subfiles_dict.values()):
+                _write_subfile(writer, ntv2_file, subfile, index == 0,
+                               tile_size, level, predictor, pool,
+                               accuracy_unit)
+                done += subfile.gs_count
+                stage.progress(done)
+            stage.count("records", total)
+            stage.count("bytes_written", output_file.tell())
+    finally:
+        pool.shutdown()
+
+
+class _Image(object):
+    # tile layout of one image of a GeoTIFF grid
+
+    def __init__(self, tags):
+        self.rows = tags[_IMAGE_LENGTH][0]
+        self.cols = tags[_IMAGE_WIDTH][0]
+        self.tile_width = tags[_TILE_WIDTH][0]
+        self.tile_length = tags[_TILE_LENGTH][0]
+        self.offsets = tags[_TILE_OFFSETS]
+        self.byte_counts = tags[_TILE_BYTE_COUNTS]
+        self.predictor = tags.get(_PREDICTOR, [1])[0] == \
+            _FLOATING_POINT_PREDICTOR
+        self.tiles_across = -(-self.cols // self.tile_width)
+        self.tile_count = -(-self.rows // self.tile_length) * \
+            self.tiles_across
+        if (tags.get(_COMPRESSION, [1])[0] != _DEFLATE or
+                tags.get(_PLANAR_CONFIGURATION, [1])[0] != 2 or
+                tags.get(_SAMPLES_PER_PIXEL, [1])[0] != 4 or
+                tags.get(_PREDICTOR, [1])[0] not in
+                (1, _FLOATING_POINT_PREDICTOR) or
+                len(self.offsets) != 4 * self.tile_count):
+            raise Exception("Unsupported GeoTIFF grid layout!")
+
+
+def _read_directories(input_file):
+    header = input_file.read(16)
+    if header[:2] != b"II" or struct.unpack("<H", header[2:4])[0] not in (
+            42, 43):
+        raise Exception("Not a little-endian TIFF file!")
+    bigtiff = struct.unpack("<H", header[2:4])[0] == 43
+    if bigtiff:
+        count_format, entry_format, inline, pointer_format = (
+            "<Q", "<HHQ", 8, "<Q")
+        offset = struct.unpack("<Q", header[8:16])[0]
+    else:
+        count_format, entry_format, inline, pointer_format = (
+            "<H", "<HHI", 4, "<I")
+        offset = struct.unpack("<I", header[4:8])[0]
+    entry_size = struct.calcsize(entry_format) + inline
+    directories = []
+    while offset:
+        input_file.seek(offset)
+        count = struct.unpack(count_format, input_file.read(
+            struct.calcsize(count_format)))[0]
+        data = input_file.read(count * entry_size +
+                               struct.calcsize(pointer_format))
+        tags = {}
+        for index in range(count):
+            entry = data[index * entry_size:(index + 1) * entry_size]
+            tag, field_type, value_count = struct.unpack(
+                entry_format, entry[:-inline])
+            if field_type not in _TYPE_FORMATS:
+                continue
+            value_format = _TYPE_FORMATS[field_type]
+            size = value_count * struct.calcsize(
+                "c" if value_format == "s" else value_format)
+            value = entry[-inline:]
+            if size > inline:
+                position = input_file.tell()
+                input_file.seek(struct.unpack(pointer_format, value)[0])
+                value = input_file.read(size)
+                input_file.seek(position)
+            if value_format == "s":
+                tags[tag] = value[:size].rstrip(b"\0").decode("ascii")
+            else:
+                tags[tag] = list(struct.unpack(
+                    "<{0}{1}".format(value_count, value_format),
+                    value[:size]))
+        directories.append(tags)
+        offset = struct.unpack(pointer_format, data[-struct.calcsize(
+            pointer_format):])[0]
+    return directories
+
+
+class GeoTIFFGrid(object):
+    """GeoTIFF grid written by write_geotiff, opened with read_geotiff.
+
+    ntv2_file holds the NTv2 headers of every subfile, without grid shifts;
+    read_region and read_subfile decompress only the tiles they need.
+    """
+
+    def __init__(self, file_path, ntv2_file, images):
+        self.file_path = file_path
+        self.ntv2_file = ntv2_file
+        self.images = images
+
+    def _read_window(self, name, row_start, row_end, col_start, col_end,
+                     workers):
+        # NTv2 rows (south to north) and columns (east to west), inclusive
+        subfile = self.ntv2_file.subfiles_dict[name]
+        image = self.images[name]
+        rows, cols = subfile.row_count, subfile.col_count
+        # the same window in TIFF rows and columns
+        top, bottom = rows - 1 - row_end, rows - 1 - row_start
+        left, right = cols - 1 - col_end, cols - 1 - col_start
+        tile_rows = range(top // image.tile_length,
+                          bottom // image.tile_length + 1)
+        tile_cols = range(left // image.tile_width,
+                          right // image.tile_width + 1)
+        tasks = []
+        with open(self.file_path, "rb") as input_file:
+            for value in range(4):
+                for tile_row in tile_rows:
+                    for tile_col in tile_cols:
+                        tile = (value * image.tile_count +
+                                tile_row * image.tiles_across + tile_col)
+                        input_file.seek(image.offsets[tile])
+                        tasks.append((value, tile_row, tile_col,
+                                      input_file.read(
+                                          image.byte_counts[tile])))
+
+        def decode(task):
+            return _decode_tile(task[3], image.predictor,
+                                image.tile_length, image.tile_width)
+
+        window = np.empty((bottom - top + 1, right - left + 1, 4),
+                          ntv2writer.RECORD_DTYPE)
+        pool = ThreadPoolExecutor(max(1, workers or
+                                      multiprocessing.cpu_count()))
+        try:
+            for (value, tile_row, tile_col, _), tile in zip(
+                    tasks, pool.map(decode, tasks)):
+                tile_top = tile_row * image.tile_length
+                tile_left = tile_col * image.tile_width
+                first_row = max(top, tile_top)
+                last_row = min(bottom, tile_top + image.tile_length - 1)
+                first_col = max(left, tile_left)
+                last_col = min(right, tile_left + image.tile_width - 1)
+                window[first_row - top:last_row - top + 1,
+                       first_col - left:last_col - left + 1, value] = tile[
+                           first_row - tile_top:last_row - tile_top + 1,
+                           first_col - tile_left:last_col - tile_left + 1]
+        finally:
+            pool.shutdown()
+        return window[::-1, ::-1]
+
+    def read_region(self, bounding_box, subfile_name=None, workers=None):
+        """Returns the nodes of a subfile inside bounding_box, chosen as
+        ntv2patch.locate_region does, and their records as a (rows, cols,
+        4) array in NTv2 order (rows south to north, columns east to
+        west)."""
+        region = ntv2patch.locate_region(self.ntv2_file, bounding_box,
+                                         subfile_name)
+        return region, self._read_window(
+            region.subfile.name, region.row_start, region.row_end,
+            region.col_start, region.col_end, workers)
+
+    def read_subfile(self, name, workers=None):
+        """Returns all the records of a subfile, in NTv2 order."""
+        subfile = self.ntv2_file.subfiles_dict[name]
+        return self._read_window(name, 0, subfile.row_count - 1, 0,
+                                 subfile.col_count - 1, workers).reshape(-1, 4)
+
+    def to_ntv2_file(self, workers=None):
+        """Decompresses every subfile into the NTv2File, ready to be
+        written with NTv2File.write_to_file."""
+        for name, subfile in self.ntv2_file.subfiles_dict.items():
+            subfile.set_gridshifts(self.read_subfile(name, workers),
+                                   overwrite=True)
+        return self.ntv2_file
+
+
+def read_geotiff(file_path):
+    """Opens a GeoTIFF grid written by write_geotiff; only the image
+    directories are read."""
+    with open(file_path, "rb") as input_file:
+        directories = _read_directories(input_file)
+    if not directories or _GDAL_METADATA not in directories[0]:
+        raise Exception("{0} is not a GeoTIFF grid!".format(file_path))
+    items = _parse_metadata(directories[0][_GDAL_METADATA])
+    if ("NTV2_GS_TYPE", None) not in items:
+        raise Exception(
+            "{0} was not written from an NTv2 file!".format(file_path))
+    axes = [float(value) for value in items[("NTV2_AXES", None)].split()]
+    ntv2_file = ntv2writer.NTv2File(items[("NTV2_GS_TYPE", None)])
+    ntv2_file.set_ref_systems(
+        ntv2writer.CRSDef(items[("NTV2_SYSTEM_F", None)], axes[0], axes[1]),
+        ntv2writer.CRSDef(items[("NTV2_SYSTEM_T", None)], axes[2], axes[3]))
+    images = collections.OrderedDict()
+    for tags in directories:
+        items = _parse_metadata(tags[_GDAL_METADATA])
+        north, south, west, east, lat_inc, long_inc = [
+            float(value) for value in items[("NTV2_LIMITS", None)].split()]
+        subfile = ntv2writer.NTv2SubFile(items[("NTV2_SUB_NAME", None)],
+                                         items[("NTV2_PARENT", None)])
+        subfile.set_limits(ntv2writer.BoundingBox(north, south, west, east))
+        subfile.set_coord_increment(
+            lat_inc, long_inc,
+            counts=items[("NTV2_SIZE", None)].split())
+        subfile.set_dates(
+            ntv2writer._parse_date(items[("NTV2_CREATED", None)]),
+            ntv2writer._parse_date(items[("NTV2_UPDATED", None)]))
+        image = _Image(tags)
+        if (image.rows, image.cols) != (subfile.row_count,
+                                        subfile.col_count):
+            raise Exception("Image size of subfile {0} does not match its "
+                            "header!".format(subfile.name))
+        ntv2_file.subfiles_dict[subfile.name] = subfile
+        images[subfile.name] = image
+    return GeoTIFFGrid(file_path, ntv2_file, images)
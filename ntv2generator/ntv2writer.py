@@ -15,15 +15,63 @@
     along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
 import datetime
+import io
+import mmap
 import os
 import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import instrumentation
+
+
+# NTv2 grid shift records are stored as 4 little-endian float32 values
+# (latitude shift, longitude shift, latitude accuracy, longitude accuracy)
+RECORD_DTYPE = np.dtype("<f4")
+RECORD_SIZE = 4 * RECORD_DTYPE.itemsize
+# records copied by one task of the parallel writer (16 MB)
+PARALLEL_BLOCK_RECORDS = 1 << 20
+# records formatted at once when writing ASCII files
+ASCII_BLOCK_RECORDS = 1 << 16
+
+# fraction of an increment by which a span may miss a whole node count
+_COUNT_TOLERANCE = 1e-6
+
+# ASCII codes of "00" to "99", read as little-endian 16-bit values
+_DIGIT_PAIRS = np.frombuffer(
+    "".join(["{0:02d}".format(i) for i in range(100)]).encode("ascii"),
+    dtype="<u2")
+
+
+def _node_count(span, increment):
+    # nodes along one axis; a span that is a multiple of the increment up
+    # to floating point errors counts as one, other spans are truncated
+    nodes = abs(span) / increment
+    if abs(nodes - round(nodes)) < _COUNT_TOLERANCE:
+        return int(round(nodes)) + 1
+    return int(nodes) + 1
 
 
 def _format_8bit_str(input_string):
     return "{0:<8}".format(input_string[:8])
 
 
+def _format_date(date):
+    # dates read from existing files may not be parseable as datetimes
+    if hasattr(date, "strftime"):
+        return date.strftime("%d%m%Y")
+    return str(date)
+
+
+def _to_bytes(input_string):
+    if isinstance(input_string, bytes):
+        return input_string
+    return input_string.encode("ascii")
+
+
 def _format_ntv2_record(name, value, type_='f', binary_format=True):
     if name == "RECORD":
         if binary_format:
@@ -34,22 +82,22 @@ def _format_ntv2_record(name, value, type_='f', binary_format=True):
         if type_ == "s":
             if binary_format:
                 return struct.pack("<8s8s",
-                                    _format_8bit_str(name),
-                                    _format_8bit_str(value))
+                                    _to_bytes(_format_8bit_str(name)),
+                                    _to_bytes(_format_8bit_str(value)))
             else:
                 return (_format_8bit_str(name) + " " +
                         _format_8bit_str(value) + "\n")
         elif type_ == "i":
             if binary_format:
                 return struct.pack("<8si4x",
-                                    _format_8bit_str(name),
+                                    _to_bytes(_format_8bit_str(name)),
                                     value)
             else:
                 return _format_8bit_str(name) + " " + str(int(value)) + "\n"
         elif type_ == "f":
             if binary_format:
                 return struct.pack("<8sd",
-                                    _format_8bit_str(name),
+                                    _to_bytes(_format_8bit_str(name)),
                                     value)
             else:
                 return (_format_8bit_str(name) + " " +
@@ -58,6 +106,81 @@ def _format_ntv2_record(name, value, type_='f', binary_format=True):
             raise Exception("Unknown record format!")
 
 
+def _as_gridshift_array(grid_shifts):
+    # Wraps NumPy arrays and raw little-endian float32 buffers without
+    # copying; anything else (lists of records, ...) is converted once.
+    if not isinstance(grid_shifts, np.ndarray):
+        try:
+            view = memoryview(grid_shifts)
+        except TypeError:
+            grid_shifts = np.asarray(grid_shifts, dtype=RECORD_DTYPE)
+        else:
+            if view.format in ("B", "b", "c"):
+                grid_shifts = np.frombuffer(view, dtype=RECORD_DTYPE)
+            else:
+                grid_shifts = np.asarray(view)
+    grid_shifts = np.asarray(grid_shifts, dtype=RECORD_DTYPE)
+    if ((grid_shifts.ndim > 1 and grid_shifts.shape[-1] != 4) or
+            grid_shifts.size % 4 != 0):
+        raise Exception("Grid shifts must contain 4 values per record!")
+    grid_shifts = grid_shifts.reshape(-1, 4)
+    return np.ascontiguousarray(grid_shifts)
+
+
+def _format_ascii_records(records):
+    # same output as formatting every value with "{0:6f}", but built as a
+    # character matrix. A float32 times 1e6 is exact in a double, so
+    # rounding it to an integer rounds like the string formatting does.
+    values = np.asarray(records, dtype=np.float64).ravel()
+    if not np.all(np.abs(values) < 1e12):
+        return "".join([_format_ntv2_record("RECORD", record, "f", False)
+                        for record in records.tolist()])
+    scaled = np.abs(np.rint(values * 1e6)).astype(np.int64)
+    integer = scaled // 1000000
+    fraction = (scaled - integer * 1000000).astype(np.int32)
+    if len(values) and integer.max() < 1 << 31:
+        integer = integer.astype(np.int32)
+    int_width = len(str(int(integer.max()))) if len(values) else 1
+    int_digits = np.ones(len(values), dtype=np.int8)
+    for digit in range(1, int_width):
+        int_digits += integer >= 10 ** digit
+    negative = np.signbit(values)
+
+    # each row is [padding][sign][integer].[6 digits][separator][padding]
+    # with an even width, so that digit pairs can be stored as 16-bit
+    # values; zero padding bytes are dropped at the end
+    width = int_width + 11
+    width += width % 2
+    chars = np.zeros((len(values), width), dtype=np.uint8)
+    pairs = chars.view("<u2")
+    separators = np.full((len(records), 4), ord(" "), dtype="<u2")
+    separators[:, 3] = ord("\n")
+    pairs[:, -1] = separators.ravel()
+    hundreds = fraction // 100
+    pairs[:, -4] = _DIGIT_PAIRS[hundreds // 100]
+    pairs[:, -3] = _DIGIT_PAIRS[hundreds % 100]
+    pairs[:, -2] = _DIGIT_PAIRS[fraction - hundreds * 100]
+    chars[:, -9] = ord(".")
+    last_column = width - 10
+    for digit in range(int_width + 1):
+        column = chars[:, last_column - digit]
+        if digit == 0:
+            column[...] = ord("0") + integer % 10
+        else:
+            column[...] = np.where(digit < int_digits,
+                                   ord("0") + integer % 10, 0)
+            column[negative & (int_digits == digit)] = ord("-")
+        integer = integer // 10
+    return chars.tobytes().translate(None, b"\0").decode("ascii")
+
+
+def _format_ntv2_records(records, binary_format=True):
+    if binary_format:
+        return records.data
+    else:
+        return _format_ascii_records(records)
+
+
 class CRSDef:
     def __init__(self, name, major_axis, minor_axis):
         self.name = name
@@ -80,7 +203,7 @@ class NTv2File:
                  coord_unit="SECONDS"):                 
         self.has_overview = False            
         self.added_sub_files = 0
-        self.subfiles_dict ={}
+        self.subfiles_dict = collections.OrderedDict()
         
         if coord_unit not in ["SECONDS", "MINUTES", "DEGREES"]:
             raise Exception("Unknown unit for coordinates!")
@@ -107,21 +230,124 @@ class NTv2File:
                 )        
         self.subfiles_dict[subFile.name] = subFile
         
-    def create_subfile(self, name, parent='NONE'):
+    def create_subfile(self, name, parent='NONE', overwrite=False):
         if name in self.subfiles_dict.keys() and not overwrite:
             raise Exception(
-                "Subfile with name {0} already exists!".format(subFile.name)
+                "Subfile with name {0} already exists!".format(name)
                 )
-        if parent!= "NONE" and subFile.parent not in self.subfiles_dict.keys():
+        if parent!= "NONE" and parent not in self.subfiles_dict.keys():
             raise Exception(
-                "Parent with name {0} was not defined!".format(subFile.name)
+                "Parent with name {0} was not defined!".format(parent)
                 )
         subFile = NTv2SubFile(name, parent)
         self.subfiles_dict[name] = subFile
         return subFile
         
     def write_to_file(self, path, name, f_format='b',
-                    overwrite=False):                    
+                    overwrite=False, workers=None):                    
+        total = sum(subfile.gs_count
+                    for subfile in self.subfiles_dict.values())
+        stage = instrumentation.current().stage(
+            "write_ntv2", total=total, file=os.path.join(path, name),
+            format=f_format)
+        with stage:
+            self._write_to_file(path, name, f_format, overwrite, workers,
+                                stage)
+            stage.count("records", total)
+            stage.count("bytes_written", os.path.getsize(self.file_name))
+
+    def write_to_geotiff(self, path, name, overwrite=False, **kwargs):
+        """Writes a tiled, compressed GeoTIFF grid instead of an NTv2 file;
+        kwargs are the options of ntv2tiff.write_geotiff."""
+        import ntv2tiff
+        ntv2tiff.write_geotiff(self, os.path.join(path, name), overwrite,
+                               **kwargs)
+
+    def _write_to_file(self, path, name, f_format, overwrite, workers,
+                       stage):
+        # workers > 1 serializes binary files from a thread pool
+        if workers is not None and workers > 1 and f_format in ['b', 'B']:
+            output_file, binary_format = self._open_output(
+                path, name, f_format, overwrite, read_write=True)
+            try:
+                self._write_parallel(output_file, workers)
+            finally:
+                output_file.close()
+            return
+
+        output_file, binary_format = self._open_output(path, name, f_format,
+                                                       overwrite)
+        self._write_header(output_file, binary_format)        
+        done = 0
+        for key in self.subfiles_dict.keys():
+            self.subfiles_dict[key].write_to_file(output_file, binary_format)           
+            done += self.subfiles_dict[key].gs_count
+            stage.progress(done)
+        self._write_eof(output_file, binary_format)
+        output_file.close()
+
+    def _binary_layout(self):
+        # every part of a binary file has a fixed size, so the offset of
+        # each subfile is known before anything is written
+        header = io.BytesIO()
+        self._write_header(header, True)
+        blocks = [(0, header.getvalue())]
+        offset = len(blocks[0][1])
+        records = []
+        for subfile in self.subfiles_dict.values():
+            subfile._check_complete()
+            header = io.BytesIO()
+            subfile._write_header(header, True)
+            blocks.append((offset, header.getvalue()))
+            offset += len(blocks[-1][1])
+            records.append((subfile, offset))
+            offset += subfile.gs_count * RECORD_SIZE
+        eof = io.BytesIO()
+        self._write_eof(eof, True)
+        blocks.append((offset, eof.getvalue()))
+        return blocks, records, offset + len(blocks[-1][1])
+
+    def _write_parallel(self, output_file, workers):
+        blocks, records, total_size = self._binary_layout()
+        output_file.truncate(total_size)
+        output_map = mmap.mmap(output_file.fileno(), total_size,
+                               access=mmap.ACCESS_WRITE)
+        try:
+            for offset, data in blocks:
+                output_map[offset:offset + len(data)] = data
+            tasks = []
+            for subfile, offset in records:
+                target = np.ndarray((subfile.gs_count, 4), RECORD_DTYPE,
+                                    buffer=output_map, offset=offset)
+                for start in range(0, subfile.gs_count,
+                                   PARALLEL_BLOCK_RECORDS):
+                    end = min(start + PARALLEL_BLOCK_RECORDS,
+                              subfile.gs_count)
+                    tasks.append((subfile, target[start:end], start, end))
+                del target
+
+            def copy_block(task):
+                subfile, target, start, end = task
+                subfile._fill_records(target, start, end)
+
+            pool = ThreadPoolExecutor(workers)
+            try:
+                for _ in pool.map(copy_block, tasks):
+                    pass
+            finally:
+                pool.shutdown()
+                del tasks
+            output_map.flush()
+        finally:
+            output_map.close()
+
+    def open_stream(self, path, name, f_format='b', overwrite=False):
+        output_file, binary_format = self._open_output(path, name, f_format,
+                                                       overwrite)
+        return NTv2StreamWriter(self, output_file, binary_format)
+
+    def _open_output(self, path, name, f_format='b', overwrite=False,
+                     read_write=False):
         self.file_name = os.path.join(path, name)        
         if os.path.exists(self.file_name) and not overwrite:
             raise Exception("File already exists!")
@@ -138,20 +364,17 @@ class NTv2File:
         if not self.subfiles_dict.keys():
             raise Exception("No subfiles have been defined!")       
             
-        if binary_format:
+        if binary_format and read_write:
+            output_file = open(self.file_name, "w+b")
+        elif binary_format:
             output_file = open(self.file_name, "wb")
         else:
             output_file = open(self.file_name, "w")
-            
-        self._write_header(output_file, binary_format)        
-        for key in self.subfiles_dict.keys():
-            self.subfiles_dict[key].write_to_file(output_file, binary_format)           
-        self._write_eof(output_file, binary_format)
-        output_file.close()
+        return output_file, binary_format
 
     def _write_eof(self, output_file, binary_format=True):
         if binary_format:
-            output_file.write(struct.pack("<8s8x", "END    "))
+            output_file.write(struct.pack("<8s8x", b"END    "))
         else:
             output_file.write("END")
         
@@ -191,7 +414,7 @@ class NTv2File:
             output_file.write("\n")
 
 
-class NTv2SubFile:
+class NTv2SubFile(object):
     def __init__(self, name, parent ='NONE'):
         self.name = name
         self.parent = parent
@@ -199,7 +422,8 @@ class NTv2SubFile:
         self.inc_set = False
         self.dates_set = False
         self.gs_count = 0
-        self.gs_list = []
+        self.gs_array = None
+        self.gs_added = 0
         
     def set_limits(self, bounding_box, overwrite=False):
         if self.bbox_set and not overwrite:
@@ -208,7 +432,9 @@ class NTv2SubFile:
         self.bbox_set = True
         
     def set_coord_increment(self, lat_increment,
-                          long_increment, overwrite=False):
+                          long_increment, overwrite=False, counts=None):
+        # counts: (rows, columns) when they are known exactly, otherwise
+        # they are derived from the limits and increments
         if not self.bbox_set:
             raise Exception(
                 "Subfile limits have to be set before setting increments!"
@@ -221,14 +447,14 @@ class NTv2SubFile:
         self.lat_increase = lat_increment
         self.long_increase = long_increment
         self.inc_set = True
-        self.gs_count = int(
-                    (abs(self.bounding_box.north-self.bounding_box.south)/
-                     self.lat_increase)
-                    + 1
-                    )* int(
-                    (abs(self.bounding_box.east-self.bounding_box.west)/
-                     self.long_increase)
-                    + 1)
+        if counts is None:
+            counts = (
+                _node_count(self.bounding_box.north-self.bounding_box.south,
+                            self.lat_increase),
+                _node_count(self.bounding_box.east-self.bounding_box.west,
+                            self.long_increase))
+        self.row_count, self.col_count = [int(count) for count in counts]
+        self.gs_count = self.row_count * self.col_count
         
     def set_dates(self, create_date, update_date=None, overwrite=False):
         if self.dates_set and not overwrite:
@@ -241,35 +467,85 @@ class NTv2SubFile:
             self.date_updated = update_date
         self.dates_set = True
 
-    def set_gridshifts(grid_shift_array, overwrite=False):
+    def set_gridshifts(self, grid_shift_array, overwrite=False):
         if not self.bbox_set or not self.inc_set:
             raise Exception(
                 "Subfile limits and increments have to be set before "
                 "setting grid shifts!"
                 ) 
-        if self.gs_list and not overwrite:
+        if self.gs_added and not overwrite:
             raise Exception("Grid shift have already been set!")
-        if len(grid_shift_array) < self.gs_count:
+        gs_array = _as_gridshift_array(grid_shift_array)
+        if len(gs_array) < self._value_count():
             raise Exception(
                 "Input array does not contain enough grid shifts. "
-                "Required entries: {0}.".format(self.gc_count)
+                "Required entries: {0}.".format(self._value_count())
                 )
-        self.gs_list = grid_shift_array
+        self.gs_array = gs_array
+        self.gs_added = len(gs_array)
 
-    def clear_gridshifts():
-        self.gs_list = []
+    def clear_gridshifts(self):
+        self.gs_array = None
+        self.gs_added = 0
 
-    def add_gridshift(latitude_shift, longitude_shift,
+    def add_gridshift(self, latitude_shift, longitude_shift,
                      latitude_accuracy, longitude_accuracy):
-        if len(self.gs_list) + 1 > self.gs_count:
+        if self.gs_added + 1 > self._value_count():
             raise Exception("All grid shifts have already been added!")
         else:
-            self.gs_list.append([
+            if self.gs_array is None:
+                self.gs_array = np.zeros((self._value_count(), 4),
+                                         RECORD_DTYPE)
+            self.gs_array[self.gs_added] = [
                 latitude_shift, longitude_shift,
                 latitude_accuracy, longitude_accuracy
-                ])                
+                ]
+            self.gs_added += 1
+
+    def grid_view(self):
+        # rows go from south to north, columns from east to west
+        if self.gs_added < self.gs_count:
+            raise Exception("Not all grid shifts have been set!")
+        return self.gs_array[:self.gs_count].reshape(self.row_count,
+                                                     self.col_count, 4)
+
+    @property
+    def gs_list(self):
+        if self.gs_array is None:
+            return []
+        return self.gs_array[:self.gs_added]
+
+    @gs_list.setter
+    def gs_list(self, grid_shifts):
+        # assigning the records, as done before set_gridshifts worked
+        if len(grid_shifts) == 0:
+            self.clear_gridshifts()
+        else:
+            self.set_gridshifts(grid_shifts, overwrite=True)
         
     def write_to_file(self, output_file, binary_format=True):
+        self._check_complete()
+        self._write_header(output_file, binary_format)
+        if binary_format:
+            output_file.write(
+                _format_ntv2_records(self.gs_array[:self.gs_count], True)
+                )
+        else:
+            for start in range(0, self.gs_count, ASCII_BLOCK_RECORDS):
+                end = min(start + ASCII_BLOCK_RECORDS, self.gs_count)
+                output_file.write(
+                    _format_ntv2_records(self.gs_array[start:end], False)
+                    )
+            output_file.write("\n")
+
+    def _fill_records(self, target, start, end):
+        target[...] = self.gs_array[start:end]
+
+    def _value_count(self):
+        # number of grid shifts held in gs_array
+        return self.gs_count
+
+    def _check_complete(self):
         if not self.bbox_set:
             raise Exception(
                 "Subfile limits have to be set before saving subfile!"
@@ -282,20 +558,12 @@ class NTv2SubFile:
             raise Exception(
                 "Subfile dates have to be set before saving subfile!"
                 )
-        if len(self.gs_list) < self.gs_count:
+        if self.gs_added < self._value_count():
             raise Exception(
                 "All grid shift points have to be added before saving "
                 "subfile " + self.name + "! "
-                "Current entries: {0}. Expected: {1}".format(len(self.gs_list),
-                                                             self.gs_count))
-        self._write_header(output_file, binary_format)
-        for grid_shift in self.gs_list:
-            self._write_record(output_file,
-                             grid_shift[0], grid_shift[1],
-                             grid_shift[2], grid_shift[3],
-                             binary_format)
-        if not binary_format:
-            output_file.write("\n")
+                "Current entries: {0}. Expected: {1}".format(
+                    self.gs_added, self._value_count()))
         
     def _write_header(self, output_file, binary_format=True):
         if not self.bbox_set:
@@ -320,10 +588,10 @@ class NTv2SubFile:
         output_file.write(_format_ntv2_record("PARENT", self.parent,
                                            "s", binary_format))
         output_file.write(_format_ntv2_record("CREATED ",
-                                           self.date_created.strftime("%d%m%Y"),
+                                           _format_date(self.date_created),
                                            "s", binary_format))
         output_file.write(_format_ntv2_record("UPDATED ",
-                                           self.date_updated.strftime("%d%m%Y"),
+                                           _format_date(self.date_updated),
                                            "s", binary_format))        
         output_file.write(_format_ntv2_record("S_LAT", self.bounding_box.south,
                                            "f", binary_format))
@@ -344,7 +612,7 @@ class NTv2SubFile:
         if not binary_format:
             output_file.write("\n")    
         
-    def _write_record(output_file,
+    def _write_record(self, output_file,
                     latitude_shift, longitude_shift,
                     latitude_accuracy, longitude_accuracy,
                     binary_format=True):
@@ -355,6 +623,266 @@ class NTv2SubFile:
                             ],
                             "f", binary_format))
 
+
+class NTv2SparseSubFile(NTv2SubFile):
+    """Subfile storing grid shifts only for runs of nodes.
+
+    Runs are given per row as (rows, starts, ends) arrays, rows from south
+    to north and columns from east to west, ends excluded, such as
+    polygonmask.mask_runs returns for Generator.select_valid_points().
+    gs_array only holds the grid shifts of the nodes inside the runs, in
+    file order; all the other nodes get zero shifts when writing.
+    """
+
+    def __init__(self, name, parent='NONE'):
+        NTv2SubFile.__init__(self, name, parent)
+        self.runs_set = False
+        self.value_count = 0
+
+    def set_runs(self, rows, starts, ends, overwrite=False):
+        if not self.bbox_set or not self.inc_set:
+            raise Exception(
+                "Subfile limits and increments have to be set before "
+                "setting runs!"
+                )
+        if self.runs_set and not overwrite:
+            raise Exception("Subfile runs have already been set!")
+        rows, starts, ends = [np.asarray(values, dtype=np.int64)
+                              for values in (rows, starts, ends)]
+        lengths = ends - starts
+        if len(rows) and (rows.min() < 0 or rows.max() >= self.row_count or
+                          starts.min() < 0 or ends.max() > self.col_count or
+                          lengths.min() <= 0):
+            raise Exception("Runs do not fit inside the subfile!")
+        first = rows * self.col_count + starts
+        if np.any(first[1:] < first[:-1] + lengths[:-1]):
+            raise Exception("Runs have to be sorted and must not overlap!")
+        self.runs = (rows, starts, ends)
+        self._run_first = first
+        self._run_last = first + lengths
+        self._run_offsets = np.cumsum(lengths) - lengths
+        self.value_count = int(lengths.sum())
+        self.runs_set = True
+        self.clear_gridshifts()
+
+    def set_gridshifts(self, grid_shift_array, overwrite=False):
+        if not self.runs_set:
+            raise Exception(
+                "Subfile runs have to be set before setting grid shifts!"
+                )
+        NTv2SubFile.set_gridshifts(self, grid_shift_array, overwrite)
+
+    def add_gridshift(self, latitude_shift, longitude_shift,
+                     latitude_accuracy, longitude_accuracy):
+        if not self.runs_set:
+            raise Exception(
+                "Subfile runs have to be set before adding grid shifts!"
+                )
+        NTv2SubFile.add_gridshift(self, latitude_shift, longitude_shift,
+                                  latitude_accuracy, longitude_accuracy)
+
+    def grid_view(self):
+        # builds the dense grid, the shifts are not stored that way
+        if not self.runs_set or self.gs_added < self.value_count:
+            raise Exception("Not all grid shifts have been set!")
+        grid = np.empty((self.gs_count, 4), RECORD_DTYPE)
+        self._fill_records(grid, 0, self.gs_count)
+        return grid.reshape(self.row_count, self.col_count, 4)
+
+    def write_to_file(self, output_file, binary_format=True):
+        self._check_complete()
+        self._write_header(output_file, binary_format)
+        block_records = (PARALLEL_BLOCK_RECORDS if binary_format
+                         else ASCII_BLOCK_RECORDS)
+        block = np.empty((min(self.gs_count, block_records), 4),
+                         RECORD_DTYPE)
+        for start in range(0, self.gs_count, len(block)):
+            end = min(start + len(block), self.gs_count)
+            self._fill_records(block[:end - start], start, end)
+            output_file.write(
+                _format_ntv2_records(block[:end - start], binary_format)
+                )
+        if not binary_format:
+            output_file.write("\n")
+
+    def save(self, file_path):
+        """Saves the runs and grid shifts to a .npz file, which
+        load_sparse_subfile reads back."""
+        self._check_complete()
+        np.savez(file_path, name=self.name, parent=self.parent,
+                 limits=[self.bounding_box.north, self.bounding_box.south,
+                         self.bounding_box.west, self.bounding_box.east],
+                 increments=[self.lat_increase, self.long_increase],
+                 counts=[self.row_count, self.col_count],
+                 dates=[_format_date(self.date_created),
+                        _format_date(self.date_updated)],
+                 runs=np.stack(self.runs),
+                 gridshifts=self.gs_array[:self.value_count])
+
+    def _fill_records(self, target, start, end):
+        target[...] = 0
+        first_run = np.searchsorted(self._run_last, start, "right")
+        last_run = np.searchsorted(self._run_first, end, "left")
+        if first_run >= last_run:
+            return
+        first = np.maximum(self._run_first[first_run:last_run], start)
+        last = np.minimum(self._run_last[first_run:last_run], end)
+        counts = last - first
+        steps = (np.arange(counts.sum()) -
+                 np.repeat(np.cumsum(counts) - counts, counts))
+        sources = (self._run_offsets[first_run:last_run] + first -
+                   self._run_first[first_run:last_run])
+        target[np.repeat(first - start, counts) + steps] = (
+            self.gs_array[np.repeat(sources, counts) + steps])
+
+    def _check_complete(self):
+        if not self.runs_set:
+            raise Exception(
+                "Subfile runs have to be set before saving subfile!"
+                )
+        NTv2SubFile._check_complete(self)
+
+    def _value_count(self):
+        return self.value_count
+
+
+def _parse_date(value):
+    try:
+        return datetime.datetime.strptime(value.strip(), "%d%m%Y")
+    except ValueError:
+        return value
+
+
+def load_sparse_subfile(file_path):
+    """Reads a subfile saved with NTv2SparseSubFile.save."""
+    with np.load(file_path) as data:
+        subfile = NTv2SparseSubFile(str(data["name"]), str(data["parent"]))
+        subfile.set_limits(BoundingBox(*data["limits"].tolist()))
+        subfile.set_coord_increment(*data["increments"].tolist(),
+                                    counts=data["counts"].tolist())
+        subfile.set_dates(*[_parse_date(str(date)) for date in data["dates"]])
+        subfile.set_runs(*data["runs"])
+        subfile.set_gridshifts(data["gridshifts"])
+    return subfile
+
+
+class NTv2StreamWriter(object):
+    """Writes an NTv2 file while the grid shifts are still being produced.
+
+    The overview header is written when the stream is opened and each
+    subfile header when the subfile is started, so only the chunk being
+    appended has to be held in memory. Records have to be supplied in NTv2
+    node order (rows from south to north, each row from east to west).
+    """
+
+    def __init__(self, ntv2_file, output_file, binary_format=True):
+        self.ntv2_file = ntv2_file
+        self.output_file = output_file
+        self.binary_format = binary_format
+        self.written_subfiles = []
+        self.current_subfile = None
+        self.records_written = 0
+        self.closed = False
+        self.ntv2_file._write_header(self.output_file, self.binary_format)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif not self.closed:
+            self.closed = True
+            self.output_file.close()
+        return False
+
+    def begin_subfile(self, name=None):
+        if self.closed:
+            raise Exception("Stream has already been closed!")
+        if self.current_subfile is not None:
+            raise Exception(
+                "Subfile {0} has not been finished!".format(
+                    self.current_subfile.name)
+                )
+        if name is None:
+            pending = [key for key in self.ntv2_file.subfiles_dict.keys()
+                       if key not in self.written_subfiles]
+            if not pending:
+                raise Exception("All subfiles have already been written!")
+            name = pending[0]
+        if name not in self.ntv2_file.subfiles_dict.keys():
+            raise Exception("Unknown subfile {0}!".format(name))
+        if name in self.written_subfiles:
+            raise Exception(
+                "Subfile {0} has already been written!".format(name)
+                )
+        subfile = self.ntv2_file.subfiles_dict[name]
+        subfile._write_header(self.output_file, self.binary_format)
+        self.current_subfile = subfile
+        self.records_written = 0
+        return subfile
+
+    def write_gridshift(self, latitude_shift, longitude_shift,
+                        latitude_accuracy, longitude_accuracy):
+        self.write_gridshifts([[latitude_shift, longitude_shift,
+                                latitude_accuracy, longitude_accuracy]])
+
+    def write_gridshifts(self, grid_shifts):
+        if self.current_subfile is None:
+            raise Exception("No subfile has been started!")
+        records = _as_gridshift_array(grid_shifts)
+        if self.records_written + len(records) > self.current_subfile.gs_count:
+            raise Exception(
+                "Too many grid shifts for subfile {0}! "
+                "Expected: {1}. Received: {2}.".format(
+                    self.current_subfile.name,
+                    self.current_subfile.gs_count,
+                    self.records_written + len(records))
+                )
+        self.output_file.write(_format_ntv2_records(records,
+                                                    self.binary_format))
+        self.records_written += len(records)
+
+    def end_subfile(self):
+        if self.current_subfile is None:
+            raise Exception("No subfile has been started!")
+        if self.records_written != self.current_subfile.gs_count:
+            raise Exception(
+                "Subfile {0} is incomplete! "
+                "Current entries: {1}. Expected: {2}".format(
+                    self.current_subfile.name, self.records_written,
+                    self.current_subfile.gs_count)
+                )
+        if not self.binary_format:
+            self.output_file.write("\n")
+        self.written_subfiles.append(self.current_subfile.name)
+        self.current_subfile = None
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if (self.current_subfile is not None and
+                    self.records_written == self.current_subfile.gs_count):
+                self.end_subfile()
+            if self.current_subfile is not None:
+                raise Exception(
+                    "Subfile {0} is incomplete! "
+                    "Current entries: {1}. Expected: {2}".format(
+                        self.current_subfile.name, self.records_written,
+                        self.current_subfile.gs_count)
+                    )
+            missing = [key for key in self.ntv2_file.subfiles_dict.keys()
+                       if key not in self.written_subfiles]
+            if missing:
+                raise Exception(
+                    "Subfiles were not written: {0}".format(", ".join(missing))
+                    )
+            self.ntv2_file._write_eof(self.output_file, self.binary_format)
+        finally:
+            self.closed = True
+            self.output_file.close()
+
    
 def _test():
     f_test = NTv2File()
@@ -0,0 +1,240 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import itertools
+
+import numpy as np
+
+import gapfill
+import instrumentation
+import ntv2writer
+import polygonmask
+
+
+def parse_point_names(names):
+    # point names are 'P' followed by the node index, so the name itself is
+    # the key into the node arrays
+    names = np.char.strip(np.asarray(names, dtype=str))
+    if len(names) and not np.all(np.char.startswith(names, "P")):
+        raise Exception("Unexpected point name in transformation results!")
+    return np.char.lstrip(names, "P").astype(np.int64)
+
+
+def read_service_output(file_path, delimiter=",", name_column=0,
+                        easting_column=1, northing_column=2, skip_lines=0,
+                        chunk_size=1000000):
+    """Reads the transformation service results in chunks.
+
+    Yields (node indices, eastings, northings) arrays for every chunk of
+    chunk_size lines; blank lines are ignored.
+    """
+    with open(file_path, "r") as input_file:
+        for _ in range(skip_lines):
+            input_file.readline()
+        while True:
+            lines = list(itertools.islice(input_file, chunk_size))
+            if not lines:
+                break
+            lines = [line.rstrip("\r\n") for line in lines]
+            lines = [line for line in lines if line.strip()]
+            if not lines:
+                continue
+            if delimiter is None:
+                fields = " ".join(lines).split()
+            else:
+                fields = delimiter.join(lines).split(delimiter)
+            column_count = len(fields) // len(lines)
+            if column_count * len(lines) != len(fields):
+                raise Exception(
+                    "Transformation results do not have the same number "
+                    "of columns on every line!"
+                    )
+            yield (parse_point_names(fields[name_column::column_count]),
+                   np.array(fields[easting_column::column_count], dtype=float),
+                   np.array(fields[northing_column::column_count], dtype=float))
+
+
+def compute_gridshifts(generator, service_output, projection,
+                       latitude_accuracy=0.0, longitude_accuracy=0.0,
+                       reverse=False, allow_missing=False, cache=None,
+                       sparse=False):
+    """Computes the NTv2 grid shifts for all the nodes of a Generator.
+
+    service_output is an iterable of (node indices, eastings, northings)
+    chunks, such as read_service_output() returns. Every chunk is projected
+    back to geographic coordinates with projection.inverse (no datum
+    shift) and differenced against the original node coordinates. Shifts
+    are in arc-seconds, target minus source (source minus target when
+    reverse is set), with longitudes positive west as NTv2 requires. Nodes
+    outside the area keep zero shifts. The result is a float32
+    (nodes x 4) array in node order, ready for NTv2SubFile.set_gridshifts.
+
+    With a NodeCache, the results of cached nodes are taken from the cache
+    (so the service only needs to transform the others) and fresh results
+    are added to it.
+
+    With sparse set, only the shifts of the nodes inside the area are
+    returned (in node order), as NTv2SparseSubFile expects.
+    """
+    mask = generator.select_valid_points()
+    row_total, col_total = mask.shape
+    node_count = row_total * col_total
+    valid = None
+    if sparse or cache is not None:
+        valid = np.flatnonzero(mask.ravel())
+    value_count = len(valid) if sparse else node_count
+    gridshifts = np.zeros((value_count, 4), dtype=ntv2writer.RECORD_DTYPE)
+    received = np.zeros(value_count, dtype=bool)
+    sign = -1.0 if reverse else 1.0
+
+    def apply(p_idx, eastings, northings):
+        if len(p_idx) and (p_idx.min() < 0 or p_idx.max() >= node_count):
+            raise Exception("Transformation results contain unknown points!")
+        if sparse:
+            # results for nodes outside the area are not kept
+            slots = np.searchsorted(valid, p_idx)
+            inside = slots < len(valid)
+            inside[inside] = valid[slots[inside]] == p_idx[inside]
+            p_idx, eastings, northings, slots = (
+                p_idx[inside], eastings[inside], northings[inside],
+                slots[inside])
+        else:
+            slots = p_idx
+        rows = p_idx // col_total
+        cols = p_idx % col_total
+        longitudes, latitudes = projection.inverse(eastings, northings)
+        lat_shift = sign*(generator.lat_values[rows] - latitudes*3600)
+        long_shift = sign*(longitudes*3600 - generator.long_values[cols])
+        gridshifts[slots, 0] = lat_shift
+        gridshifts[slots, 1] = long_shift
+        gridshifts[slots, 2] = latitude_accuracy
+        gridshifts[slots, 3] = longitude_accuracy
+        received[slots] = True
+        return rows, cols, slots, eastings, northings
+
+    stage = instrumentation.current().stage(
+        "gridshifts", total=int(np.count_nonzero(mask)))
+    with stage:
+        done = 0
+        if cache is not None:
+            rows = valid // col_total
+            cols = valid % col_total
+            found, values = cache.lookup(generator.lat_values[rows],
+                                         generator.long_values[cols])
+            apply(valid[found], values["easting"][found],
+                  values["northing"][found])
+            done = int(np.count_nonzero(found))
+            stage.count("cached_nodes", done)
+
+        for p_idx, eastings, northings in service_output:
+            rows, cols, slots, eastings, northings = apply(p_idx, eastings,
+                                                           northings)
+            if cache is not None:
+                cache.store(generator.lat_values[rows],
+                            generator.long_values[cols],
+                            eastings, northings, gridshifts[slots])
+            done += len(p_idx)
+            stage.count("service_results", len(p_idx))
+            stage.progress(done)
+        if cache is not None:
+            cache.flush()
+
+    if sparse:
+        missing = np.count_nonzero(~received)
+    else:
+        outside = ~mask.ravel()
+        gridshifts[outside] = 0
+        missing = np.count_nonzero(~received & ~outside)
+    if missing and not allow_missing:
+        raise Exception(
+            "{0} points inside the area are missing from the "
+            "transformation results!".format(missing)
+            )
+    return gridshifts
+
+
+def fill_buffer(generator, gridshifts, buffer_nodes, method="harmonic",
+                sparse=False):
+    """Extrapolates the dense grid shifts of a Generator into a buffer of
+    buffer_nodes nodes around the area (see gapfill.fill_gridshifts).
+    Returns the grid shifts, only those of the area and its buffer when
+    sparse is set, and the mask of the nodes they cover."""
+    mask = generator.select_valid_points()
+    with instrumentation.current().stage("gap_fill", method=method) as stage:
+        gridshifts, covered = gapfill.fill_gridshifts(
+            gridshifts, mask, buffer_nodes, method)
+        stage.count("buffer_nodes",
+                    int(np.count_nonzero(covered) - np.count_nonzero(mask)))
+    if sparse:
+        gridshifts = gridshifts[covered.ravel()]
+    return gridshifts, covered
+
+
+def create_subfile(generator, name, gridshifts, parent="NONE",
+                   create_date=None, sparse=False, mask=None):
+    """Wraps grid shifts computed for a Generator into an NTv2SubFile, or
+    into an NTv2SparseSubFile covering the area only when sparse is set
+    (or the nodes of mask, when given)."""
+    if sparse:
+        subfile = ntv2writer.NTv2SparseSubFile(name, parent)
+    else:
+        subfile = ntv2writer.NTv2SubFile(name, parent)
+    subfile.set_limits(ntv2writer.BoundingBox(generator.bbox.north,
+                                              generator.bbox.south,
+                                              generator.bbox.west,
+                                              generator.bbox.east))
+    subfile.set_coord_increment(generator.lat_increment,
+                                generator.long_increment,
+                                counts=(len(generator.lat_values),
+                                        len(generator.long_values)))
+    if create_date is None:
+        create_date = datetime.datetime.now()
+    subfile.set_dates(create_date)
+    if sparse:
+        if mask is None:
+            mask = generator.select_valid_points()
+        subfile.set_runs(*polygonmask.mask_runs(mask))
+    subfile.set_gridshifts(gridshifts)
+    return subfile
+
+
+def run(generator, service_output_path, projection, ntv2_file, name,
+        parent="NONE", **kwargs):
+    """Steps 3 and 4 of the workflow: reads the transformation results,
+    computes the grid shifts and adds them to ntv2_file as a subfile.
+    With fill_buffer set, shifts are extrapolated that many nodes around
+    the area (with fill_method, see fill_buffer)."""
+    read_args = dict((key, kwargs.pop(key)) for key in
+                     ["delimiter", "name_column", "easting_column",
+                      "northing_column", "skip_lines", "chunk_size"]
+                     if key in kwargs)
+    buffer_nodes = kwargs.pop("fill_buffer", 0)
+    fill_method = kwargs.pop("fill_method", "harmonic")
+    sparse = kwargs.pop("sparse", False)
+    # the fill works on the dense grid
+    gridshifts = compute_gridshifts(
+        generator, read_service_output(service_output_path, **read_args),
+        projection, sparse=sparse and not buffer_nodes, **kwargs)
+    mask = None
+    if buffer_nodes:
+        gridshifts, mask = fill_buffer(generator, gridshifts, buffer_nodes,
+                                       fill_method, sparse)
+    subfile = create_subfile(generator, name, gridshifts, parent,
+                             sparse=sparse, mask=mask)
+    ntv2_file.add_subfile(subfile)
+    return subfile
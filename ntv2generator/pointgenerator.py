@@ -15,12 +15,31 @@
     along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+import itertools
+import multiprocessing
+import os
 import string
 import random
 
-from osgeo import ogr,osr
+import numpy as np
 
+import arealoader
+import instrumentation
 import ntv2writer
+import polygonmask
+
+
+# GDAL is only imported when an OGR datasource or layer is needed
+ogr = None
+osr = None
+
+
+def _import_gdal():
+        global ogr, osr
+        if ogr is None:
+                from osgeo import ogr as ogr_module, osr as osr_module
+                ogr, osr = ogr_module, osr_module
 
 
 def _id_generator(size=6, chars=string.ascii_uppercase + string.digits):
@@ -34,27 +53,167 @@ def _dec_to_dms(decimal):
         seconds = seconds - minutes*60
         return "{0} {1} {2}".format(degrees,minutes,seconds)
 
+def _dec_to_dms_array(decimals):
+        # same arithmetic as _dec_to_dms, done once for a whole array
+        seconds = np.asarray(decimals, dtype=float)*3600
+        degrees = np.trunc(seconds/3600)
+        seconds = seconds-(degrees*3600)
+        minutes = np.trunc(seconds/60)
+        seconds = seconds - minutes*60
+        return ["{0} {1} {2}".format(d,m,s) for d,m,s in
+                zip(degrees.astype(np.int64).tolist(),
+                    minutes.astype(np.int64).tolist(),
+                    seconds.tolist())]
+
+
+class _SplitWriter:
+        # writes point lines to one file, or to numbered files holding at
+        # most max_points points each
+        def __init__(self, file_path, max_points=None, header="\n",
+                     buffer_size=1<<20):
+                self.file_path = file_path
+                self.max_points = max_points
+                self.header = header
+                self.buffer_size = buffer_size
+                self.file_paths = []
+                self.output = None
+                self.points_in_file = 0
+
+        def _next_file(self):
+                if self.output is not None:
+                        self.output.close()
+                if self.max_points is None:
+                        path = self.file_path
+                else:
+                        root, ext = os.path.splitext(self.file_path)
+                        path = "{0}_{1:03d}{2}".format(root,
+                                                       len(self.file_paths)+1,
+                                                       ext)
+                self.output = open(path, "w", self.buffer_size)
+                self.output.write(self.header)
+                self.file_paths.append(path)
+                self.points_in_file = 0
+
+        def write(self, lines):
+                if self.output is None:
+                        self._next_file()
+                if self.max_points is None:
+                        self.output.write("".join(lines))
+                        return
+                start = 0
+                while start < len(lines):
+                        if self.points_in_file >= self.max_points:
+                                self._next_file()
+                        end = min(len(lines),
+                                  start + self.max_points - self.points_in_file)
+                        self.output.write("".join(lines[start:end]))
+                        self.points_in_file += end - start
+                        start = end
+
+        def close(self):
+                if self.output is None:
+                        self._next_file()
+                self.output.close()
+                return self.file_paths
+
+
+_tile_state = {}
+
+def _init_tile_worker(rings, lat_values, long_values):
+        _tile_state['rings'] = rings
+        _tile_state['lat_values'] = lat_values
+        _tile_state['long_values'] = long_values
+
+def _generate_tile(rows):
+        # valid nodes of the row band [rows[0], rows[1]), numbered like the
+        # whole grid
+        row_start, row_end = rows
+        lat_values = _tile_state['lat_values'][row_start:row_end]
+        long_values = _tile_state['long_values']
+        mask = polygonmask.scanline_mask(_tile_state['rings'], lat_values,
+                                         long_values)
+        return _tile_points(mask, row_start, lat_values, long_values)
+
+def _tile_points(mask, row_start, lat_values, long_values):
+        tile_rows, cols = np.nonzero(mask)
+        p_idx = (tile_rows + row_start)*len(long_values) + cols
+        return (p_idx, lat_values[tile_rows]/3600., long_values[cols]/3600.)
+
+def _geometry_polygons(geom):
+        # OGR polygon or multipolygon as lists of (longitude, latitude) rings
+        if geom.GetGeometryType() == ogr.wkbPolygon:
+                polygons = [geom]
+        else:
+                polygons = [geom.GetGeometryRef(i)
+                            for i in range(geom.GetGeometryCount())]
+        result = []
+        for polygon in polygons:
+                rings = []
+                for i in range(polygon.GetGeometryCount()):
+                        points = polygon.GetGeometryRef(i).GetPoints()
+                        if points:
+                                rings.append(np.array(points, dtype=float)[:, :2])
+                result.append(rings)
+        return result
+
+def _geometry_rings(geom):
+        return [ring for polygon in _geometry_polygons(geom) for ring in polygon]
+
 
 class Generator:
         def __init__(self, input_dataset, verify_gcs=False):
+                with instrumentation.current().stage("open_area",
+                                                     dataset=str(input_dataset)):
+                        self._open_area(input_dataset, verify_gcs)
+
+                self.increment_set=False
+                self.points_generated=False
+                self.layer_created=False
+                self.valid_mask=None
+
+        def _open_area(self, input_dataset, verify_gcs):
+                if isinstance(input_dataset, arealoader.RingGeometry):
+                        # area already loaded, e.g. one region of a batch
+                        self.ds = None
+                        self.layer = None
+                        self.spatial_ref = None
+                        self.geom = input_dataset
+                        self.rings = self.geom.rings
+                        return
+                if arealoader.is_supported(input_dataset):
+                        # GeoJSON and WKT areas are read without GDAL
+                        features = arealoader.read_features(input_dataset,
+                                                            verify_gcs)
+                        if len(features) == 0:
+                                raise Exception("No feature found in "+input_dataset)
+                        elif len(features) > 1:
+                                raise Exception("More than one feature found in "+input_dataset)
+                        self.ds = None
+                        self.layer = None
+                        self.spatial_ref = None
+                        self.geom = arealoader.RingGeometry(features[0][1])
+                        self.rings = self.geom.rings
+                        return
+
+                _import_gdal()
                 self.ds=ogr.Open(input_dataset)
                 self.layer=self.ds.GetLayer()
                 
                 if self.layer is None:
-                        raise Exception("Unable to open "+extent_file+" for reading!")
+                        raise Exception("Unable to open "+input_dataset+" for reading!")
                         
                 no_features=self.layer.GetFeatureCount()
                 if no_features == 0:
-                        raise Exception("No feature found in "+extent_file)
+                        raise Exception("No feature found in "+input_dataset)
                 elif no_features > 1:
-                        raise Exception("More than one feature found in "+extent_file)
+                        raise Exception("More than one feature found in "+input_dataset)
 
                 self.wgs84=osr.SpatialReference()
                 self.wgs84.ImportFromWkt(osr.SRS_WKT_WGS84)
                 self.spatial_ref=self.layer.GetSpatialRef()
                
                 if verify_gcs:
-                        if not self.spatial_ref.IsSameGeogCS(wgs84):
+                        if not self.spatial_ref.IsSameGeogCS(self.wgs84):
                                 raise Exception("Input must be in WGS84!")
 
                 self.geom = None
@@ -67,11 +226,12 @@ class Generator:
                 if (geom_type is not ogr.wkbMultiPolygon and
                     geom_type is not ogr.wkbPolygon):
                         raise Exception("A polygon input is required!")
+                self.rings = _geometry_rings(self.geom)
 
-                self.increment_set=False
-                self.points_generated=False
-
-        def set_increments(self, lat_increment=30, long_increment=30, overwrite=False):
+        def set_increments(self, lat_increment=30, long_increment=30, overwrite=False,
+                           align=False):
+                # with align, the south-west corner is moved to a multiple of
+                # the increments, so that areas sharing them share their nodes
                 if self.increment_set and not overwrite:
                         raise Exception("Coordinate increments have already been set!")
                 if self.increment_set and overwrite:
@@ -81,6 +241,9 @@ class Generator:
                                               env[2]*3600,
                                               env[0]*3600,
                                               env[1]*3600)
+                if align:
+                        self.bbox.south = (self.bbox.south//lat_increment)*lat_increment
+                        self.bbox.west = (self.bbox.west//long_increment)*long_increment
 
                 self.lat_count = int(abs(self.bbox.north - self.bbox.south)/lat_increment) + 1
                 self.long_count = int(abs(self.bbox.east -  self.bbox.west)/long_increment) + 1
@@ -90,20 +253,46 @@ class Generator:
                 self.long_increment=long_increment
                 self.increment_set=True
 
-        def generate_points(self, overwrite=False):
+        def generate_points(self, overwrite=False, create_layer=False):
                 if not self.increment_set:
                         raise Exception("Increments not set!")
 
-                temp_file=_id_generator(16)
-
                 if self.points_generated and not overwrite:
                         raise Exception("Points have already been generated")
 
-                if self.points_generated and overwrite:
+                if self.layer_created:
                         self.t_layer.Dereference()
                         self.t_datasource.Destroy()
+                        self.layer_created=False
 
-                
+                # nodes are numbered row by row from south to north, each row
+                # from east to west, which is also the NTv2 record order
+                with instrumentation.current().stage("generate_points") as stage:
+                        self.lat_values = (self.bbox.south +
+                                           np.arange(self.lat_count+1)*self.lat_increment)
+                        self.long_values = (self.bbox.east -
+                                            np.arange(self.long_count+1)*self.long_increment)
+                        stage.count("nodes", len(self.lat_values)*len(self.long_values))
+                self.valid_mask = None
+                self.points_generated=True
+
+                if create_layer:
+                        self.create_layer()
+
+        def create_layer(self):
+                # OGR memory layer holding all nodes, kept for compatibility
+                if not self.points_generated:
+                        self.generate_points()
+                _import_gdal()
+                if isinstance(self.geom, arealoader.RingGeometry):
+                        self.spatial_ref = osr.SpatialReference()
+                        self.spatial_ref.ImportFromWkt(osr.SRS_WKT_WGS84)
+                        self.geom = ogr.CreateGeometryFromWkt(self.geom.ExportToWkt())
+                if self.layer_created:
+                        self.t_layer.Dereference()
+                        self.t_datasource.Destroy()
+
+                temp_file=_id_generator(16)
                 driver = ogr.GetDriverByName('Memory')
                 self.t_datasource = driver.CreateDataSource(temp_file)
                 if self.t_datasource is None:
@@ -119,49 +308,154 @@ class Generator:
                 field.Destroy()
 
                 p_idx=0
-                for x in [self.bbox.south + i*self.lat_increment
-                          for i in range(self.lat_count+1)]:
-                        for y in [self.bbox.east - j*self.long_increment
-                                   for j in range(self.long_count+1)]:
+                for x in self.lat_values:
+                        for y in self.long_values:
                                 point = ogr.Geometry(ogr.wkbPoint)
                                 point.AddPoint(y/3600., x/3600.)
-                                #print x/3600., y/3600.
                                 inRow = ogr.Feature(self.t_layer.GetLayerDefn())
                                 inRow.SetField('pointName', 'P' + str(p_idx))
                                 inRow.SetGeometryDirectly(point)
                                 self.t_layer.CreateFeature(inRow)
                                 inRow.Destroy()
                                 p_idx = p_idx + 1
-                                
-                self.points_generated=True
+                self.layer_created=True
+                return self.t_layer
 
         def select_valid_points(self):
                 if not self.increment_set:
                         raise Exception("Increments not set!")
-                
-                self.t_layer.ResetReading()
-                self.t_layer.SetSpatialFilter(self.geom)
+                if not self.points_generated:
+                        self.generate_points()
+
+                if self.valid_mask is None:
+                        with instrumentation.current().stage("mask") as stage:
+                                rings = [ring*3600 for ring in self.rings]
+                                self.valid_mask = polygonmask.scanline_mask(
+                                        rings, self.lat_values, self.long_values)
+                                stage.count("valid_nodes",
+                                            int(np.count_nonzero(self.valid_mask)))
+                if self.layer_created:
+                        self.t_layer.ResetReading()
+                        self.t_layer.SetSpatialFilter(self.geom)
+                return self.valid_mask
 
-        def dump_to_file(self, file_path, country='RO'):                
+        def get_valid_points(self):
+                # point indices and coordinates (decimal degrees) of the
+                # nodes inside the area
+                mask = self.select_valid_points()
+                rows, cols = np.nonzero(mask)
+                p_idx = rows*len(self.long_values) + cols
+                return (p_idx, self.lat_values[rows]/3600.,
+                        self.long_values[cols]/3600.)
+
+        def iter_point_chunks(self, rows_per_tile=256, workers=1):
+                # yields (p_idx, latitudes, longitudes) of the valid nodes,
+                # one row band at a time and in p_idx order; with workers > 1
+                # (None for all cores) the bands are computed by a process
+                # pool, keeping only a few of them in memory
+                if not self.increment_set:
+                        raise Exception("Increments not set!")
                 if not self.points_generated:
                         self.generate_points()
-                
-                self.select_valid_points()
+                if workers is None:
+                        workers = multiprocessing.cpu_count()
+                row_total = len(self.lat_values)
+                bands = [(start, min(start+rows_per_tile, row_total))
+                         for start in range(0, row_total, rows_per_tile)]
+
+                if self.valid_mask is not None:
+                        for start, end in bands:
+                                yield _tile_points(self.valid_mask[start:end],
+                                                   start,
+                                                   self.lat_values[start:end],
+                                                   self.long_values)
+                        return
+
+                rings = [ring*3600 for ring in self.rings]
+                if workers <= 1:
+                        _init_tile_worker(rings, self.lat_values,
+                                          self.long_values)
+                        for band in bands:
+                                yield _generate_tile(band)
+                        return
+
+                pool = multiprocessing.Pool(workers, _init_tile_worker,
+                                            (rings, self.lat_values,
+                                             self.long_values))
+                try:
+                        pending = collections.deque()
+                        bands = iter(bands)
+                        for band in itertools.islice(bands, 2*workers):
+                                pending.append(pool.apply_async(_generate_tile,
+                                                                (band,)))
+                        while pending:
+                                result = pending.popleft().get()
+                                band = next(bands, None)
+                                if band is not None:
+                                        pending.append(pool.apply_async(
+                                                _generate_tile, (band,)))
+                                yield result
+                finally:
+                        pool.terminate()
+                        pool.join()
+
+        def dump_to_file(self, file_path, country='RO', max_points=None,
+                         chunk_size=1000000, workers=1, rows_per_tile=256,
+                         cache=None):
+                # max_points splits the output into numbered files
+                # (name_001.txt, ...) for services limiting the batch size;
+                # nodes already present in cache (a NodeCache) are skipped
+                if not self.points_generated:
+                        self.generate_points()
+                if max_points is not None and max_points < 1:
+                        raise Exception("max_points has to be positive!")
+
                 if country == 'RO':
-                        csv=open(file_path,"w")
-                        csv.write("\n")
-                        for feature in self.t_layer:
-                            csv.write(feature.GetField('pointName')+","+
-                                      _dec_to_dms(feature.GetGeometryRef().GetY())+","+
-                                      _dec_to_dms(feature.GetGeometryRef().GetX())+"\n")
-                        csv.close()
+                        # every row shares its latitude and every column its
+                        # longitude, so each is converted to DMS only once
+                        lat_dms = _dec_to_dms_array(self.lat_values/3600.)
+                        long_dms = _dec_to_dms_array(self.long_values/3600.)
+                        col_total = len(self.long_values)
+
+                        row_total = len(self.lat_values)
+                        stage = instrumentation.current().stage(
+                                "dump", total=row_total, file=str(file_path))
+                        with stage:
+                                writer = _SplitWriter(file_path, max_points)
+                                lines = []
+                                for band, (p_idx, latitudes, longitudes) in enumerate(
+                                                self.iter_point_chunks(rows_per_tile,
+                                                                       workers)):
+                                        if cache is not None:
+                                                p_idx = p_idx[~cache.contains(
+                                                        latitudes*3600, longitudes*3600)]
+                                        rows = (p_idx // col_total).tolist()
+                                        cols = (p_idx % col_total).tolist()
+                                        lines.extend(["P%d,%s,%s\n" % (idx, lat_dms[row],
+                                                                       long_dms[col])
+                                                      for idx, row, col in
+                                                      zip(p_idx.tolist(), rows, cols)])
+                                        if len(lines) >= chunk_size:
+                                                writer.write(lines)
+                                                lines = []
+                                        stage.count("points", len(p_idx))
+                                        stage.progress(min((band+1)*rows_per_tile,
+                                                           row_total))
+                                writer.write(lines)
+                                paths = writer.close()
+                                if cache is not None:
+                                        cache.flush()
+                                stage.count("bytes_written",
+                                            sum(os.path.getsize(path) for path in paths))
+                        return paths
                 else:
                         raise Exception("Unknow ouput format")
                 
         def cleanup(self):
-                self.layer.Dereference()
-                self.ds.Release()
-                if self.points_generated:
+                if self.ds is not None:
+                        self.layer.Dereference()
+                        self.ds.Release()
+                if self.layer_created:
                         self.t_layer.Dereference()
                         self.t_datasource.Destroy()
                 del self
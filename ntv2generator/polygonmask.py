@@ -0,0 +1,171 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+
+# distance, relative to the coordinate magnitudes, within which a node is
+# taken to lie on a horizontal edge or a vertex
+EDGE_TOLERANCE = 1e-9
+
+
+def _ring_edges(rings):
+    starts = []
+    ends = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=float)[:, :2]
+        if len(ring) < 3:
+            continue
+        starts.append(ring)
+        # rings are closed implicitly, a repeated first vertex just adds a
+        # degenerate edge that is dropped below
+        ends.append(np.roll(ring, -1, axis=0))
+    if not starts:
+        return np.empty((0, 2)), np.empty((0, 2))
+    return np.concatenate(starts), np.concatenate(ends)
+
+
+def _sort_axis(values):
+    # returns the sorted values and the index restoring the original order
+    if np.all(values[1:] >= values[:-1]):
+        return values, slice(None)
+    if np.all(values[1:] <= values[:-1]):
+        return values[::-1], slice(None, None, -1)
+    order = np.argsort(values, kind="mergesort")
+    return values[order], np.argsort(order)
+
+
+def scanline_mask(rings, latitudes, longitudes):
+    """Marks the lattice nodes lying inside the polygon described by rings.
+
+    rings is a sequence of (n, 2) arrays of (longitude, latitude) vertices
+    given in the same units as the node coordinates; holes and the parts of
+    a multipolygon are all passed as rings and combined with the even-odd
+    rule. Returns a boolean array of shape (len(latitudes),
+    len(longitudes)). Nodes lying on an edge or a vertex are considered
+    inside, like OGR Intersects does.
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    lat_sorted, lat_index = _sort_axis(latitudes)
+    long_sorted, long_index = _sort_axis(longitudes)
+    row_count = len(lat_sorted)
+    col_count = len(long_sorted)
+
+    start, end = _ring_edges(rings)
+    sloped = start[:, 1] != end[:, 1]
+    x0, y0 = start[sloped, 0], start[sloped, 1]
+    x1, y1 = end[sloped, 0], end[sloped, 1]
+
+    # each edge crosses the scanlines with y_min <= lat < y_max; the
+    # half-open rule makes every ring cross each scanline an even number of
+    # times
+    first_row = np.searchsorted(lat_sorted, np.minimum(y0, y1), "left")
+    last_row = np.searchsorted(lat_sorted, np.maximum(y0, y1), "left")
+    counts = last_row - first_row
+    total = int(counts.sum())
+    if total == 0 or col_count == 0 or row_count == 0:
+        return np.zeros((row_count, col_count), dtype=bool)
+
+    edge_idx = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = first_row[edge_idx] + offsets
+    y = lat_sorted[rows]
+    x = (x0[edge_idx] + (y - y0[edge_idx]) *
+         (x1[edge_idx] - x0[edge_idx]) / (y1[edge_idx] - y0[edge_idx]))
+
+    order = np.lexsort((x, rows))
+    rows = rows[order][0::2]
+    x = x[order]
+    span_start = np.searchsorted(long_sorted, x[0::2], "left")
+    span_end = np.searchsorted(long_sorted, x[1::2], "right")
+    keep = span_end > span_start
+    rows, span_start, span_end = rows[keep], span_start[keep], span_end[keep]
+
+    # spans of a row never overlap, so a running sum of +1/-1 markers is 1
+    # exactly inside them
+    markers = np.zeros((row_count, col_count + 1), dtype=np.int8)
+    np.add.at(markers, (rows, span_start), 1)
+    np.add.at(markers, (rows, span_end), -1)
+    np.cumsum(markers, axis=1, dtype=np.int8, out=markers)
+    inside = markers[:, :-1] > 0
+    _add_boundary(inside, start, end, lat_sorted, long_sorted)
+    return inside[lat_index][:, long_index]
+
+
+def _add_boundary(inside, start, end, lat_sorted, long_sorted):
+    # the half-open rule leaves out the nodes on horizontal edges and on
+    # vertices at the top of a ring, so these are added as closed spans
+    flat = start[:, 1] == end[:, 1]
+    span_west = np.concatenate([np.minimum(start[flat, 0], end[flat, 0]),
+                                start[:, 0]])
+    span_east = np.concatenate([np.maximum(start[flat, 0], end[flat, 0]),
+                                start[:, 0]])
+    span_lat = np.concatenate([start[flat, 1], start[:, 1]])
+    tolerance = EDGE_TOLERANCE * max(
+        1.0, abs(lat_sorted[0]), abs(lat_sorted[-1]),
+        abs(long_sorted[0]), abs(long_sorted[-1]))
+    first_row = np.searchsorted(lat_sorted, span_lat - tolerance, "left")
+    last_row = np.searchsorted(lat_sorted, span_lat + tolerance, "right")
+    first_col = np.searchsorted(long_sorted, span_west - tolerance, "left")
+    last_col = np.searchsorted(long_sorted, span_east + tolerance, "right")
+    hit = np.flatnonzero((last_row > first_row) & (last_col > first_col))
+    for row0, row1, col0, col1 in zip(first_row[hit], last_row[hit],
+                                      first_col[hit], last_col[hit]):
+        inside[row0:row1, col0:col1] = True
+
+
+def mask_runs(mask, block_rows=1024):
+    """Returns the runs of set nodes of every row of a boolean mask as
+    (rows, starts, ends) arrays, ends excluded, in row major order."""
+    mask = np.asarray(mask, dtype=bool)
+    row_count, col_count = mask.shape
+    rows, starts, ends = [], [], []
+    for first in range(0, row_count, block_rows):
+        block = mask[first:first + block_rows].astype(np.int8)
+        edges = np.diff(block, axis=1, prepend=0, append=0)
+        run_rows, run_starts = np.nonzero(edges > 0)
+        run_ends = np.nonzero(edges < 0)[1]
+        rows.append(run_rows + first)
+        starts.append(run_starts)
+        ends.append(run_ends)
+    if not rows:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    return (np.concatenate(rows).astype(np.int64),
+            np.concatenate(starts).astype(np.int64),
+            np.concatenate(ends).astype(np.int64))
+
+
+def _test():
+    # 45..46 degree square at 60 arc-seconds: every boundary node is inside
+    ring = np.array([[90000.0, 162000.0], [93600.0, 162000.0],
+                     [93600.0, 165600.0], [90000.0, 165600.0]])
+    latitudes = 162000.0 + 60.0 * np.arange(61)
+    longitudes = 90000.0 + 60.0 * np.arange(61)
+    mask = scanline_mask([ring], latitudes, longitudes)
+    assert mask.all(), "boundary nodes of the square are missing"
+    # columns from east to west, rows around the square
+    mask = scanline_mask([ring], 161940.0 + 60.0 * np.arange(63),
+                         longitudes[::-1])
+    assert not mask[0].any() and not mask[-1].any()
+    assert mask[1:-1].all()
+    # the apex of a triangle is inside too
+    triangle = np.array([[0.0, 0.0], [10.0, 0.0], [5.0, 5.0]])
+    mask = scanline_mask([triangle], np.arange(7.0), np.arange(11.0))
+    assert mask[5, 5] and mask[5].sum() == 1 and not mask[6].any()
+    assert mask[0].all()
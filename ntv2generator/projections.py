@@ -0,0 +1,111 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+
+import numpy as np
+
+import ntv2writer
+
+
+class ObliqueStereographic:
+    """Oblique stereographic projection (EPSG method 9809, PROJ 'sterea').
+
+    Works on whole arrays of coordinates and never applies a datum shift:
+    geographic coordinates are on the projection's own ellipsoid.
+    """
+
+    def __init__(self, crs, latitude_origin, longitude_origin, scale_factor,
+                 false_easting, false_northing):
+        a = float(crs.major_axis)
+        b = float(crs.minor_axis)
+        self.crs = crs
+        self.e2 = 1 - (b*b)/(a*a)
+        self.e = math.sqrt(self.e2)
+        self.k0 = scale_factor
+        self.false_easting = false_easting
+        self.false_northing = false_northing
+        self.lambda0 = math.radians(longitude_origin)
+
+        phi0 = math.radians(latitude_origin)
+        sin_phi0 = math.sin(phi0)
+        rho0 = a*(1 - self.e2)/(1 - self.e2*sin_phi0**2)**1.5
+        nu0 = a/math.sqrt(1 - self.e2*sin_phi0**2)
+        self.radius = math.sqrt(rho0*nu0)
+        self.n = math.sqrt(1 + self.e2*math.cos(phi0)**4/(1 - self.e2))
+        s1 = (1 + sin_phi0)/(1 - sin_phi0)
+        s2 = (1 - self.e*sin_phi0)/(1 + self.e*sin_phi0)
+        w1 = (s1*s2**self.e)**self.n
+        sin_chi0 = (w1 - 1)/(w1 + 1)
+        self.c = ((self.n + sin_phi0)*(1 - sin_chi0)/
+                  ((self.n - sin_phi0)*(1 + sin_chi0)))
+        w2 = self.c*w1
+        self.chi0 = math.asin((w2 - 1)/(w2 + 1))
+
+    def forward(self, longitude, latitude):
+        """Projects decimal degrees to (easting, northing) in meters."""
+        phi = np.radians(np.asarray(latitude, dtype=float))
+        big_lambda = (self.n*(np.radians(np.asarray(longitude, dtype=float)) -
+                              self.lambda0))
+        sin_phi = np.sin(phi)
+        sa = (1 + sin_phi)/(1 - sin_phi)
+        sb = (1 - self.e*sin_phi)/(1 + self.e*sin_phi)
+        w = self.c*(sa*sb**self.e)**self.n
+        chi = np.arcsin((w - 1)/(w + 1))
+        cos_chi = np.cos(chi)
+        sin_chi = np.sin(chi)
+        b = (1 + sin_chi*math.sin(self.chi0) +
+             cos_chi*math.cos(self.chi0)*np.cos(big_lambda))
+        scale = 2*self.radius*self.k0/b
+        easting = self.false_easting + scale*cos_chi*np.sin(big_lambda)
+        northing = self.false_northing + scale*(
+            sin_chi*math.cos(self.chi0) -
+            cos_chi*math.sin(self.chi0)*np.cos(big_lambda))
+        return easting, northing
+
+    def inverse(self, easting, northing, iterations=8):
+        """Converts (easting, northing) in meters back to decimal degrees,
+        returned as (longitude, latitude)."""
+        dx = np.asarray(easting, dtype=float) - self.false_easting
+        dy = np.asarray(northing, dtype=float) - self.false_northing
+        two_rk0 = 2*self.radius*self.k0
+        g = two_rk0*math.tan(math.pi/4 - self.chi0/2)
+        h = 2*two_rk0*math.tan(self.chi0) + g
+        i = np.arctan(dx/(h + dy))
+        j = np.arctan(dx/(g - dy)) - i
+        chi = self.chi0 + 2*np.arctan((dy - dx*np.tan(j/2))/two_rk0)
+        big_lambda = j + 2*i
+        longitude = big_lambda/self.n + self.lambda0
+
+        sin_chi = np.sin(chi)
+        psi = 0.5*np.log((1 + sin_chi)/(self.c*(1 - sin_chi)))/self.n
+        phi = 2*np.arctan(np.exp(psi)) - math.pi/2
+        for _ in range(iterations):
+            sin_phi = np.sin(phi)
+            psi_i = np.log(np.tan(phi/2 + math.pi/4)*
+                           ((1 - self.e*sin_phi)/
+                            (1 + self.e*sin_phi))**(self.e/2))
+            phi = phi - ((psi_i - psi)*np.cos(phi)*(1 - self.e2*sin_phi**2)/
+                         (1 - self.e2))
+        return np.degrees(longitude), np.degrees(phi)
+
+
+KRASSOWSKY_CRS = ntv2writer.CRSDef("Stereo70", 6378245.0, 6356863.019)
+
+# Romanian national projection (EPSG:31700) without its datum shift
+STEREO70 = ObliqueStereographic(KRASSOWSKY_CRS, 46.0, 25.0, 0.99975,
+                                500000.0, 500000.0)
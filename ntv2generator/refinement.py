@@ -0,0 +1,170 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+import ntv2writer
+
+
+def _axis_weights(count, step):
+    # lower lattice index and weight of the upper one for every dense node
+    positions = np.arange(count)
+    lower = positions // step
+    weight = (positions % step) / float(step)
+    upper = np.minimum(lower + 1, (count - 1) // step)
+    return lower, upper, weight
+
+
+def upsample_bilinear(coarse, step, rows, cols):
+    """Bilinearly interpolates a lattice taken every step nodes back onto
+    the dense (rows x cols) lattice, where rows = (coarse rows - 1) * step
+    + 1 (same for cols). Extra trailing dimensions are interpolated
+    independently."""
+    lower, upper, weight = _axis_weights(rows, step)
+    weight = weight.reshape((-1,) + (1,) * (coarse.ndim - 1))
+    by_rows = coarse[lower] * (1 - weight) + coarse[upper] * weight
+    lower, upper, weight = _axis_weights(cols, step)
+    weight = weight.reshape((1, -1) + (1,) * (coarse.ndim - 2))
+    return (by_rows[:, lower] * (1 - weight) +
+            by_rows[:, upper] * weight)
+
+
+def _pad_to_step(grid, step):
+    # extends the grid north and east (edge values) so that both
+    # dimensions span a whole number of coarse cells
+    rows, cols = grid.shape[:2]
+    pad_rows = (-(rows - 1)) % step
+    pad_cols = (-(cols - 1)) % step
+    if pad_rows or pad_cols:
+        grid = np.pad(grid, ((0, pad_rows), (0, pad_cols), (0, 0)), "edge")
+    return grid
+
+
+def _cell_errors(grid, step):
+    # largest shift error inside every cell of the lattice taken every step
+    # nodes, using the cell edges as well
+    rows, cols = grid.shape[:2]
+    shifts = grid[:, :, :2].astype(float)
+    interpolated = upsample_bilinear(shifts[::step, ::step], step, rows, cols)
+    errors = np.abs(interpolated - shifts).max(axis=2).astype(np.float32)
+    cell_rows = (rows - 1) // step
+    cell_cols = (cols - 1) // step
+    cells = errors[:-1, :-1].reshape(cell_rows, step, cell_cols, step)
+    cells = cells.max(axis=(1, 3))
+    cells[-1, :] = np.maximum(
+        cells[-1, :], errors[-1, :-1].reshape(cell_cols, step).max(axis=1))
+    cells[:, -1] = np.maximum(
+        cells[:, -1], errors[:-1, -1].reshape(cell_rows, step).max(axis=1))
+    cells[-1, -1] = max(cells[-1, -1], errors[-1, -1])
+    return cells
+
+
+class _Refiner:
+    def __init__(self, source, grid, tolerance, tile_cells, prefix,
+                 lat_increment, long_increment):
+        self.source = source
+        self.grid = grid
+        self.tolerance = tolerance
+        self.tile_cells = tile_cells
+        self.prefix = prefix
+        self.lat_increment = lat_increment
+        self.long_increment = long_increment
+        self.cell_errors = {}
+        self.subfiles = []
+
+    def errors(self, step):
+        if step not in self.cell_errors:
+            self.cell_errors[step] = _cell_errors(self.grid, step)
+        return self.cell_errors[step]
+
+    def create_subfile(self, name, parent, r0, r1, c0, c1, step):
+        # the working grid has its columns from west to east
+        block = self.grid[r0:r1 + 1:step, c0:c1 + 1:step, :][:, ::-1]
+        south = self.source.bounding_box.south
+        west = self.source.bounding_box.west
+        subfile = ntv2writer.NTv2SubFile(name, parent)
+        subfile.set_limits(ntv2writer.BoundingBox(
+            south + r1 * self.lat_increment, south + r0 * self.lat_increment,
+            west + c0 * self.long_increment, west + c1 * self.long_increment))
+        subfile.set_coord_increment(step * self.lat_increment,
+                                    step * self.long_increment,
+                                    counts=block.shape[:2])
+        subfile.set_dates(self.source.date_created, self.source.date_updated)
+        subfile.set_gridshifts(np.ascontiguousarray(block).reshape(-1, 4))
+        self.subfiles.append(subfile)
+        return subfile
+
+    def refine(self, r0, r1, c0, c1, step, parent):
+        errors = self.errors(step)[r0 // step:r1 // step, c0 // step:c1 // step]
+        if step == 1 or errors.max() <= self.tolerance:
+            return
+        cell_rows = (r1 - r0) // step
+        cell_cols = (c1 - c0) // step
+        if cell_rows > self.tile_cells or cell_cols > self.tile_cells:
+            # quadtree split at the same spacing until the failing area is
+            # small enough to be worth a child grid
+            row_cuts = [r0, r1]
+            col_cuts = [c0, c1]
+            if cell_rows > 1:
+                row_cuts = [r0, r0 + (cell_rows // 2) * step, r1]
+            if cell_cols > 1:
+                col_cuts = [c0, c0 + (cell_cols // 2) * step, c1]
+            for i in range(len(row_cuts) - 1):
+                for j in range(len(col_cuts) - 1):
+                    self.refine(row_cuts[i], row_cuts[i + 1],
+                                col_cuts[j], col_cuts[j + 1], step, parent)
+            return
+        name = "{0}{1}".format(self.prefix, len(self.subfiles))
+        if len(name) > 8:
+            raise Exception("Too many subfiles for prefix " + self.prefix)
+        child = self.create_subfile(name, parent, r0, r1, c0, c1, step // 2)
+        self.refine(r0, r1, c0, c1, step // 2, child.name)
+
+
+def refine_subfile(source, tolerance, coarse_factor=16, tile_cells=16,
+                   name=None, prefix="R", ntv2_file=None):
+    """Builds an adaptive hierarchy of subfiles from a dense subfile.
+
+    The parent keeps every coarse_factor-th node of source (a power of two).
+    Wherever bilinear interpolation of a grid departs from the dense shifts
+    by more than tolerance (in the units of the shifts), a child subfile
+    with half its spacing is added, snapped to the parent nodes, recursively
+    down to the source spacing. Failing areas larger than tile_cells parent
+    cells are first split as a quadtree. The parent may extend north and
+    east of source by less than one coarse cell, using edge values.
+
+    Returns the subfiles, parents first; they are also added to ntv2_file
+    when one is given.
+    """
+    if coarse_factor < 1 or coarse_factor & (coarse_factor - 1):
+        raise Exception("The coarse factor has to be a power of two!")
+    if tile_cells < 1:
+        raise Exception("Tiles have to contain at least one cell!")
+    if name is None:
+        name = source.name
+    grid = _pad_to_step(source.grid_view()[:, ::-1], coarse_factor)
+    refiner = _Refiner(source, grid, tolerance, tile_cells, prefix,
+                       source.lat_increase, source.long_increase)
+    rows, cols = grid.shape[:2]
+    parent = refiner.create_subfile(name, "NONE", 0, rows - 1, 0, cols - 1,
+                                    coarse_factor)
+    refiner.refine(0, rows - 1, 0, cols - 1, coarse_factor, parent.name)
+
+    if ntv2_file is not None:
+        for subfile in refiner.subfiles:
+            ntv2_file.add_subfile(subfile)
+    return refiner.subfiles
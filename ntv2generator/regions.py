@@ -0,0 +1,429 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+Batch generation of several regions (one feature each) into one NTv2 file.
+"""
+
+import collections
+import math
+import multiprocessing
+
+import numpy as np
+
+import arealoader
+import nodecache
+import pipeline
+import pointgenerator
+import polygonmask
+
+
+# node coordinates are compared after rounding to this (arc-seconds)
+NODE_QUANTUM = 0.001
+
+
+def _property(properties, field, default=None):
+    # shapefile field names are often upper case
+    for key, value in properties.items():
+        if key.lower() == field.lower() and value is not None:
+            return value
+    return default
+
+
+def _ogr_features(input_dataset, verify_gcs):
+    pointgenerator._import_gdal()
+    ogr = pointgenerator.ogr
+    osr = pointgenerator.osr
+    ds = ogr.Open(input_dataset)
+    layer = ds.GetLayer() if ds is not None else None
+    if layer is None:
+        raise Exception("Unable to open "+input_dataset+" for reading!")
+    if verify_gcs:
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromWkt(osr.SRS_WKT_WGS84)
+        if not layer.GetSpatialRef().IsSameGeogCS(wgs84):
+            raise Exception("Input must be in WGS84!")
+    features = []
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            raise Exception("Unable to read geometry")
+        if geom.GetGeometryType() not in (ogr.wkbPolygon, ogr.wkbMultiPolygon):
+            raise Exception("A polygon input is required!")
+        features.append((feature.items(),
+                         pointgenerator._geometry_polygons(geom)))
+    return features
+
+
+def _parent_cells(child_low, child_high, parent_low, parent_increment):
+    # parent cells (from parent_low) containing the child extent, allowing
+    # for the rounding of coordinates computed from floats
+    low = math.floor((child_low - parent_low) / parent_increment + 1e-9)
+    high = math.ceil((child_high - parent_low) / parent_increment - 1e-9)
+    return low, high
+
+
+def _increment_ratio(parent_increment, child_increment):
+    ratio = parent_increment / child_increment
+    if round(ratio) < 1 or abs(ratio - round(ratio)) > 1e-9 * ratio:
+        return None
+    return int(round(ratio))
+
+
+def _snap_to_parent(region, parent):
+    # NTv2 children have to start and end on parent nodes, so the child
+    # extent grows outwards to the next parent nodes
+    child = region.generator
+    outer = parent.generator
+    lat_ratio = _increment_ratio(outer.lat_increment, child.lat_increment)
+    long_ratio = _increment_ratio(outer.long_increment, child.long_increment)
+    if lat_ratio is None or long_ratio is None:
+        raise Exception(
+            "The increments of region {0} do not divide those of its parent "
+            "{1}!".format(region.name, parent.name))
+    south, north = _parent_cells(child.bbox.south, child.bbox.north,
+                                 outer.bbox.south, outer.lat_increment)
+    west, east = _parent_cells(child.bbox.west, child.bbox.east,
+                               outer.bbox.west, outer.long_increment)
+    if (south < 0 or west < 0 or north > outer.lat_count or
+            east > outer.long_count):
+        raise Exception("Region {0} extends beyond its parent {1}!".format(
+            region.name, parent.name))
+    child.bbox.south = outer.bbox.south + south * outer.lat_increment
+    child.bbox.north = outer.bbox.south + north * outer.lat_increment
+    child.bbox.west = outer.bbox.west + west * outer.long_increment
+    child.bbox.east = outer.bbox.west + east * outer.long_increment
+    child.lat_count = (north - south) * lat_ratio
+    child.long_count = (east - west) * long_ratio
+    child.points_generated = False
+    child.valid_mask = None
+
+
+def _region_mask(args):
+    rings, lat_values, long_values = args
+    return polygonmask.scanline_mask(rings, lat_values, long_values)
+
+
+def _overlaps(area, generator):
+    # whether the envelope of an area (rings in decimal degrees) meets the
+    # node extent of generator
+    points = np.concatenate(area.rings) * 3600
+    return (points[:, 0].min() <= generator.long_values.max() and
+            points[:, 0].max() >= generator.long_values.min() and
+            points[:, 1].min() <= generator.lat_values.max() and
+            points[:, 1].max() >= generator.lat_values.min())
+
+
+class Region(object):
+    """One area of a batch, becoming one subfile named name (at most 8
+    characters), nested under parent. Its nodes are aligned to multiples
+    of the increments (arc-seconds)."""
+
+    def __init__(self, name, geometry, lat_increment, long_increment,
+                 parent="NONE", properties=None):
+        if not name or len(name) > 8:
+            raise Exception("Invalid subfile name for region: " + str(name))
+        self.name = name
+        self.parent = parent
+        self.properties = properties or {}
+        self.generator = pointgenerator.Generator(geometry)
+        self.generator.set_increments(lat_increment, long_increment,
+                                      align=True)
+
+
+def read_regions(input_dataset, lat_increment=30, long_increment=30,
+                 name_field="name", parent_field="parent",
+                 lat_increment_field="lat_inc",
+                 long_increment_field="long_inc", verify_gcs=False):
+    """Creates a Region for every feature of input_dataset (GeoJSON and WKT
+    are read directly, other formats through OGR). The subfile name, the
+    parent and the increments are taken from the feature fields when
+    present, field names being matched without case."""
+    if arealoader.is_supported(input_dataset):
+        features = arealoader.read_features(input_dataset, verify_gcs)
+    else:
+        features = _ogr_features(input_dataset, verify_gcs)
+    if not features:
+        raise Exception("No feature found in "+input_dataset)
+    regions = []
+    for index, (properties, polygons) in enumerate(features):
+        regions.append(Region(
+            str(_property(properties, name_field, "R{0:03d}".format(index))),
+            arealoader.RingGeometry(polygons),
+            float(_property(properties, lat_increment_field, lat_increment)),
+            float(_property(properties, long_increment_field,
+                            long_increment)),
+            str(_property(properties, parent_field, "NONE")),
+            properties))
+    return regions
+
+
+class RegionBatch(object):
+    """Generates the nodes of several regions at once.
+
+    The extent of a region nested in a parent is widened to the nodes of
+    the parent, whose increments have to be multiples of the region ones;
+    a region extending beyond its parent is an error.
+
+    PROJ interpolates every point inside the extent of a subfile from that
+    subfile (the first top-level one containing it, then its innermost
+    child), so the nodes of a region lying in the area of any region of
+    the batch get shifts, not only those inside its own polygon: around a
+    child the parent area, where top-level regions overlap the other area.
+
+    Nodes shared by overlapping regions (same coordinates) are sent to the
+    transformation service only once: the points written by dump_to_file
+    are the distinct nodes of all regions, named "P" followed by their
+    index in that table, and compute_gridshifts maps the results back to
+    every region.
+    """
+
+    def __init__(self, regions):
+        by_name = collections.OrderedDict()
+        for region in regions:
+            if region.name in by_name:
+                raise Exception("Duplicate region name: " + region.name)
+            by_name[region.name] = region
+        # parents have to come before their children in the file
+        ordered = []
+        placed = set(["NONE"])
+        while len(ordered) < len(by_name):
+            ready = [region for region in by_name.values()
+                     if region.name not in placed and region.parent in placed]
+            if not ready:
+                raise Exception("Regions have unknown or circular parents!")
+            ordered.extend(ready)
+            placed.update(region.name for region in ready)
+        # parents are snapped before their children
+        for region in ordered:
+            if region.parent != "NONE":
+                _snap_to_parent(region, by_name[region.parent])
+        self.regions = ordered
+        self.node_count = None
+
+    def prepare(self, workers=1):
+        """Computes the masks of all the regions (with a process pool when
+        workers > 1, None for all cores) and the table of distinct nodes.
+        Returns the number of distinct nodes."""
+        generators = [region.generator for region in self.regions]
+        for generator in generators:
+            if not generator.points_generated:
+                generator.generate_points()
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        # one mask per region and area of the batch meeting its extent
+        owners = []
+        tasks = []
+        for index, generator in enumerate(generators):
+            for area in generators:
+                if _overlaps(area, generator):
+                    owners.append(index)
+                    tasks.append(([ring*3600 for ring in area.rings],
+                                  generator.lat_values, generator.long_values))
+        if workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(workers, len(tasks)))
+            try:
+                masks = pool.map(_region_mask, tasks)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            masks = [_region_mask(task) for task in tasks]
+        for generator in generators:
+            generator.valid_mask = np.zeros(
+                (len(generator.lat_values), len(generator.long_values)),
+                dtype=bool)
+        for index, mask in zip(owners, masks):
+            generators[index].valid_mask |= mask
+
+        self.region_nodes = []
+        latitudes = []
+        longitudes = []
+        for generator in generators:
+            col_total = len(generator.long_values)
+            nodes = np.flatnonzero(generator.select_valid_points().ravel())
+            self.region_nodes.append(nodes)
+            latitudes.append(generator.lat_values[nodes // col_total])
+            longitudes.append(generator.long_values[nodes % col_total])
+        latitudes = np.concatenate(latitudes)
+        longitudes = np.concatenate(longitudes)
+        keys, first, inverse = np.unique(
+            nodecache.node_keys(latitudes, longitudes, NODE_QUANTUM)[0],
+            return_index=True, return_inverse=True)
+        self.node_latitudes = latitudes[first]
+        self.node_longitudes = longitudes[first]
+        self.node_count = len(keys)
+        # distinct node index of every valid node of every region
+        sizes = [len(nodes) for nodes in self.region_nodes]
+        self.region_slots = np.split(inverse.ravel(), np.cumsum(sizes)[:-1])
+        return self.node_count
+
+    def _check_prepared(self):
+        if self.node_count is None:
+            self.prepare()
+
+    def iter_point_chunks(self, chunk_size=1000000, cache=None):
+        """Yields (p_idx, latitudes, longitudes) of the distinct nodes, in
+        decimal degrees, such as transformclient.BatchSubmitter reads;
+        nodes found in cache (a NodeCache) are skipped."""
+        self._check_prepared()
+        for start in range(0, self.node_count, chunk_size):
+            end = min(start + chunk_size, self.node_count)
+            p_idx = np.arange(start, end)
+            latitudes = self.node_latitudes[start:end]
+            longitudes = self.node_longitudes[start:end]
+            if cache is not None:
+                keep = ~cache.contains(latitudes, longitudes)
+                p_idx = p_idx[keep]
+                latitudes = latitudes[keep]
+                longitudes = longitudes[keep]
+            yield p_idx, latitudes/3600., longitudes/3600.
+        if cache is not None:
+            cache.flush()
+
+    def dump_to_file(self, file_path, country='RO', max_points=None,
+                     chunk_size=1000000, cache=None):
+        """Writes the distinct nodes for the transformation service, like
+        Generator.dump_to_file; returns the list of files written."""
+        if country != 'RO':
+            raise Exception("Unknow ouput format")
+        if max_points is not None and max_points < 1:
+            raise Exception("max_points has to be positive!")
+        writer = pointgenerator._SplitWriter(file_path, max_points)
+        for p_idx, latitudes, longitudes in self.iter_point_chunks(
+                chunk_size, cache):
+            lat_dms = pointgenerator._dec_to_dms_array(latitudes)
+            long_dms = pointgenerator._dec_to_dms_array(longitudes)
+            writer.write(["P%d,%s,%s\n" % point for point in
+                          zip(p_idx.tolist(), lat_dms, long_dms)])
+        return writer.close()
+
+    def compute_gridshifts(self, service_output, projection, **kwargs):
+        """Reads the service results for the distinct nodes and computes
+        the grid shifts of every region with pipeline.compute_gridshifts
+        (kwargs are passed on). Returns them by region name."""
+        self._check_prepared()
+        eastings = np.zeros(self.node_count)
+        northings = np.zeros(self.node_count)
+        received = np.zeros(self.node_count, dtype=bool)
+        for p_idx, chunk_eastings, chunk_northings in service_output:
+            if len(p_idx) and (p_idx.min() < 0 or
+                               p_idx.max() >= self.node_count):
+                raise Exception(
+                    "Transformation results contain unknown points!")
+            eastings[p_idx] = chunk_eastings
+            northings[p_idx] = chunk_northings
+            received[p_idx] = True
+
+        gridshifts = collections.OrderedDict()
+        for region, nodes, slots in zip(self.regions, self.region_nodes,
+                                        self.region_slots):
+            found = received[slots]
+            results = [(nodes[found], eastings[slots[found]],
+                        northings[slots[found]])]
+            gridshifts[region.name] = pipeline.compute_gridshifts(
+                region.generator, results, projection, **kwargs)
+        return gridshifts
+
+    def create_subfiles(self, gridshifts, ntv2_file=None, create_date=None,
+                        sparse=False, masks=None):
+        """Creates one subfile per region, parents first, and adds them to
+        ntv2_file when given. masks (by region name) are the nodes covered
+        by sparse subfiles, when not only the areas."""
+        subfiles = []
+        for region in self.regions:
+            subfile = pipeline.create_subfile(
+                region.generator, region.name, gridshifts[region.name],
+                region.parent, create_date, sparse,
+                (masks or {}).get(region.name))
+            subfiles.append(subfile)
+            if ntv2_file is not None:
+                ntv2_file.add_subfile(subfile)
+        return subfiles
+
+    def run(self, service_output_path, projection, ntv2_file, **kwargs):
+        """Steps 3 and 4 for all the regions, like pipeline.run."""
+        read_args = dict((key, kwargs.pop(key)) for key in
+                         ["delimiter", "name_column", "easting_column",
+                          "northing_column", "skip_lines", "chunk_size"]
+                         if key in kwargs)
+        buffer_nodes = kwargs.pop("fill_buffer", 0)
+        fill_method = kwargs.pop("fill_method", "harmonic")
+        sparse = kwargs.pop("sparse", False)
+        gridshifts = self.compute_gridshifts(
+            pipeline.read_service_output(service_output_path, **read_args),
+            projection, sparse=sparse and not buffer_nodes, **kwargs)
+        masks = {}
+        if buffer_nodes:
+            for region in self.regions:
+                gridshifts[region.name], masks[region.name] = \
+                    pipeline.fill_buffer(region.generator,
+                                         gridshifts[region.name],
+                                         buffer_nodes, fill_method, sparse)
+        return self.create_subfiles(gridshifts, ntv2_file, sparse=sparse,
+                                    masks=masks)
+
+
+def _test():
+    # points inside the extent of a subfile but outside its own polygon
+    # have to get the shifts of the area they lie in
+    import asyncio
+    import os
+    import shutil
+    import tempfile
+
+    import ntv2interpolator
+    import ntv2reader
+    import ntv2writer
+    import projections
+    import transformclient
+
+    def area(*points):
+        return arealoader.RingGeometry([[np.array(points + points[:1])]])
+
+    batch = RegionBatch([
+        Region("A", area((23.0, 45.0), (23.8, 45.0), (23.0, 45.8)), 60, 60),
+        Region("B", area((23.6, 45.5), (24.2, 45.5), (24.2, 46.0),
+                         (23.6, 46.0)), 60, 60),
+        Region("C", area((23.1, 45.1), (23.3, 45.1), (23.1, 45.3)), 10, 10,
+               parent="A")])
+    directory = tempfile.mkdtemp()
+    try:
+        paths = batch.dump_to_file(os.path.join(directory, "points.txt"))
+        with open(paths[0]) as points:
+            lines = points.readlines()
+        results = os.path.join(directory, "results.txt")
+        with open(results, "w") as output:
+            output.write(asyncio.run(
+                transformclient.LocalTransformationService().transform(lines)))
+        ntv2_file = ntv2writer.NTv2File()
+        ntv2_file.set_ref_systems(ntv2writer.ETRS89_CRS,
+                                  ntv2writer.ETRS89_CRS)
+        batch.run(results, projections.STEREO70, ntv2_file)
+        ntv2_file.write_to_file(directory, "regions.gsb")
+        interpolator = ntv2interpolator.NTv2Interpolator(
+            ntv2reader.read_ntv2_file(os.path.join(directory, "regions.gsb")))
+        # in the child extent, outside the child, inside its parent; in the
+        # extent of A, outside A, inside B; inside the child
+        longitudes = np.array([23.28, 23.12, 23.7, 23.15])
+        latitudes = np.array([45.28, 45.29, 45.6, 45.15])
+        lat_shift, long_shift = interpolator.interpolate(longitudes,
+                                                         latitudes)
+        expected_lat, expected_long = transformclient.synthetic_shift(
+            longitudes, latitudes)
+        assert np.allclose(lat_shift, expected_lat, atol=1e-3), lat_shift
+        assert np.allclose(long_shift, expected_long, atol=1e-3), long_shift
+    finally:
+        shutil.rmtree(directory)
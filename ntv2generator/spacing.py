@@ -0,0 +1,255 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+Chooses the grid spacing (Generator.set_increments) from a dense reference
+grid: every candidate spacing is resampled from the reference and the
+bilinear interpolation error is measured at the reference nodes.
+"""
+
+import numpy as np
+
+
+DEFAULT_PERCENTILES = (50, 95, 99)
+# reference nodes processed at once
+BLOCK_NODES = 1 << 20
+
+
+class SpacingCandidate(object):
+    """Interpolation residuals (arc-seconds, the larger of the latitude and
+    longitude errors at every reference node) of a grid lat_factor and
+    long_factor times coarser than the reference.
+
+    node_count is the number of candidate nodes inside the reference;
+    only the evaluated_count reference nodes lying in cells with all four
+    corners inside the reference, for every candidate evaluated together,
+    are scored; the unevaluated_count others are not."""
+
+    def __init__(self, lat_factor, long_factor, lat_increment,
+                 long_increment, node_count, maximum, rms, percentiles,
+                 evaluated_count=None, unevaluated_count=0):
+        self.lat_factor = lat_factor
+        self.long_factor = long_factor
+        self.lat_increment = lat_increment
+        self.long_increment = long_increment
+        self.node_count = node_count
+        self.evaluated_count = evaluated_count
+        self.unevaluated_count = unevaluated_count
+        self.max = maximum
+        self.rms = rms
+        self.percentiles = percentiles
+
+    def statistic(self, name):
+        if name == "max":
+            return self.max
+        if name == "rms":
+            return self.rms
+        if name not in self.percentiles:
+            raise Exception("Unknown residual statistic: {0}".format(name))
+        return self.percentiles[name]
+
+    def __repr__(self):
+        return ("SpacingCandidate({0}x{1}, increments {2}/{3}, {4} nodes, "
+                "max {5:.6f}, rms {6:.6f})".format(
+                    self.lat_factor, self.long_factor, self.lat_increment,
+                    self.long_increment, self.node_count, self.max,
+                    self.rms))
+
+
+def _leading_nodes(origin, increment, factor, align):
+    # reference nodes between the coarse grid corner and the reference one:
+    # set_increments with align moves the corner down to a multiple of the
+    # increment, otherwise both grids start at the same corner
+    if not align:
+        return 0
+    nodes = origin / increment
+    if abs(nodes - round(nodes)) > 1e-6:
+        raise Exception(
+            "The reference grid is not aligned to its increments!")
+    return int(round(nodes)) % factor
+
+
+def _covered_nodes(count, lead, factor):
+    # reference indices of the first and last candidate nodes inside the
+    # reference along one axis; only the nodes between them lie in cells
+    # whose corners are all reference nodes
+    first = (-lead) % factor
+    if first > count - 1:
+        return first, first - factor
+    return first, first + (count - 1 - first) // factor * factor
+
+
+def _node_count(count, lead, factor):
+    # candidate nodes inside the reference along one axis
+    first, last = _covered_nodes(count, lead, factor)
+    return max(0, (last - first) // factor + 1)
+
+
+def _cell_corners(count, factor):
+    # reference index of the corners of the cells along one axis, for a
+    # reference starting and ending on candidate nodes; the last node
+    # starts one more cell, whose far corner (repeating the last one) is
+    # only ever given a zero weight
+    cells = (count - 1) // factor + 1
+    return np.minimum(np.arange(cells + 1) * factor, count - 1)
+
+
+def _residuals(planes, valid, lat_factor, long_factor, block_nodes):
+    # residuals at the valid reference nodes, band of coarse cells by band;
+    # every band is interpolated as (cell rows, lat_factor, cell columns,
+    # long_factor) so that no reference sized index arrays are needed
+    rows, cols = planes.shape[1:]
+    row_corners = _cell_corners(rows, lat_factor)
+    col_corners = _cell_corners(cols, long_factor)
+    cell_cols = len(col_corners) - 1
+    lat_weights = (np.arange(lat_factor, dtype=np.float32) /
+                   lat_factor)[:, None, None]
+    long_weights = np.arange(long_factor, dtype=np.float32) / long_factor
+    band_cells = max(1, block_nodes // (cell_cols * lat_factor * long_factor))
+    residuals = []
+    for first in range(0, len(row_corners) - 1, band_cells):
+        last = min(first + band_cells, len(row_corners) - 1)
+        start = first * lat_factor
+        end = min(last * lat_factor, rows)
+        errors = None
+        for plane in planes:
+            corners = plane[row_corners[first:last + 1]][:, col_corners]
+            base = corners[:-1, :-1]
+            by_rows = corners[1:, :-1] - base
+            by_cols = corners[:-1, 1:] - base
+            cross = corners[1:, 1:] - corners[1:, :-1] - by_cols
+            base, by_rows, by_cols, cross = [
+                values[:, None, :, None]
+                for values in (base, by_rows, by_cols, cross)]
+            interpolated = ((base + lat_weights * by_rows) +
+                            long_weights * (by_cols + lat_weights * cross))
+            interpolated = interpolated.reshape(
+                (last - first) * lat_factor, cell_cols * long_factor)
+            error = np.abs(interpolated[:end - start, :cols] -
+                           plane[start:end])
+            if errors is None:
+                errors = error
+            else:
+                np.maximum(errors, error, out=errors)
+        if valid is not None:
+            errors = errors[valid[start:end]]
+        residuals.append(errors.ravel())
+    return np.concatenate(residuals)
+
+
+def evaluate_spacings(reference, factors=None, align=True, mask=None,
+                      percentiles=DEFAULT_PERCENTILES,
+                      block_nodes=BLOCK_NODES):
+    """Measures how well coarser grids reproduce a dense reference subfile.
+
+    Every factor (an integer, or a (latitude, longitude) pair of integers)
+    gives a candidate grid with increments that many times the reference
+    ones, its corner snapped like Generator.set_increments does (with
+    align, as regions do, the reference must be aligned too). Its nodes are
+    taken from the reference and interpolated back bilinearly; residuals
+    are measured at all the reference nodes, or at those of mask (a boolean
+    grid in the reference node order, such as
+    Generator.select_valid_points returns). All the candidates are scored
+    on the same reference nodes: those lying, for every factor, in a
+    candidate cell fully inside the reference. Reference nodes beyond the
+    last row or column of any candidate are not evaluated. Factors default
+    to 2 to 32.
+
+    Returns a SpacingCandidate per factor.
+    """
+    if factors is None:
+        factors = range(2, 33)
+    grid = reference.grid_view()
+    # one plane per shift, columns from west to east so that the coarse
+    # corner comes first
+    planes = np.ascontiguousarray(grid[:, ::-1, :2].transpose(2, 0, 1),
+                                  dtype=np.float32)
+    valid = None
+    if mask is not None:
+        valid = np.asarray(mask, dtype=bool)
+        if valid.shape != grid.shape[:2]:
+            raise Exception("The mask does not match the reference grid!")
+        valid = valid[:, ::-1]
+    total = (grid.shape[0] * grid.shape[1] if valid is None
+             else int(np.count_nonzero(valid)))
+    layouts = []
+    for factor in factors:
+        lat_factor, long_factor = (factor if isinstance(factor, tuple)
+                                   else (factor, factor))
+        if lat_factor < 1 or long_factor < 1:
+            raise Exception("Spacing factors have to be positive integers!")
+        lat_lead = _leading_nodes(reference.bounding_box.south,
+                                  reference.lat_increase, lat_factor, align)
+        long_lead = _leading_nodes(reference.bounding_box.west,
+                                   reference.long_increase, long_factor,
+                                   align)
+        rows = _covered_nodes(grid.shape[0], lat_lead, lat_factor)
+        cols = _covered_nodes(grid.shape[1], long_lead, long_factor)
+        if rows[1] <= rows[0] or cols[1] <= cols[0]:
+            raise Exception(
+                "The reference is smaller than one cell of factor "
+                "{0}x{1}!".format(lat_factor, long_factor))
+        layouts.append((lat_factor, long_factor, lat_lead, long_lead,
+                        rows, cols))
+    if not layouts:
+        return []
+
+    # reference nodes covered by every candidate, so that all of them are
+    # scored on the same nodes
+    row_spans = [layout[4] for layout in layouts]
+    col_spans = [layout[5] for layout in layouts]
+    scored = np.zeros(grid.shape[:2], dtype=bool)
+    scored[max(first for first, _ in row_spans):
+           min(last for _, last in row_spans) + 1,
+           max(first for first, _ in col_spans):
+           min(last for _, last in col_spans) + 1] = True
+    if valid is not None:
+        scored &= valid
+
+    candidates = []
+    for lat_factor, long_factor, lat_lead, long_lead, rows, cols in layouts:
+        residuals = _residuals(
+            planes[:, rows[0]:rows[1] + 1, cols[0]:cols[1] + 1],
+            scored[rows[0]:rows[1] + 1, cols[0]:cols[1] + 1],
+            lat_factor, long_factor, block_nodes)
+        if not len(residuals):
+            raise Exception("No reference node to compare with!")
+        values = np.percentile(residuals, percentiles) if percentiles else []
+        candidates.append(SpacingCandidate(
+            lat_factor, long_factor,
+            lat_factor * reference.lat_increase,
+            long_factor * reference.long_increase,
+            _node_count(grid.shape[0], lat_lead, lat_factor) *
+            _node_count(grid.shape[1], long_lead, long_factor),
+            float(residuals.max()),
+            float(np.sqrt(np.mean(np.square(residuals, dtype=float)))),
+            dict(zip(percentiles, [float(value) for value in values])),
+            len(residuals), total - len(residuals)))
+    return candidates
+
+
+def choose_spacing(reference, tolerance, statistic="max", **kwargs):
+    """Returns the candidate with the fewest nodes whose residual statistic
+    ("max", "rms" or one of the percentiles) is within tolerance
+    (arc-seconds), or None, and all the candidates (see
+    evaluate_spacings, which receives kwargs)."""
+    candidates = evaluate_spacings(reference, **kwargs)
+    passing = [candidate for candidate in candidates
+               if candidate.statistic(statistic) <= tolerance]
+    best = None
+    if passing:
+        best = min(passing, key=lambda candidate: (
+            candidate.node_count, -candidate.lat_factor))
+    return best, candidates
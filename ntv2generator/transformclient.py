@@ -0,0 +1,212 @@
+"""
+    This file is part of ntv2generator.
+
+    ntv2generator is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ntv2generator is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ntv2generator.  If not, see <http://www.gnu.org/licenses/>.
+
+Batched submission of the generated points to the transformation service
+(step 2 of the workflow). Requests carry points in the 'RO' dump format
+("name,D M S,D M S" lines, latitude first) and services answer with
+"name,easting,northing" lines, which is what pipeline.read_service_output
+reads by default. Requires Python 3 (asyncio).
+"""
+
+import asyncio
+import random
+import urllib.request
+
+import numpy as np
+
+import pipeline
+import pointgenerator
+import projections
+
+
+def format_points(p_idx, latitudes, longitudes):
+    lat_dms = pointgenerator._dec_to_dms_array(latitudes)
+    long_dms = pointgenerator._dec_to_dms_array(longitudes)
+    return ["P%d,%s,%s\n" % point
+            for point in zip(p_idx.tolist(), lat_dms, long_dms)]
+
+
+def parse_points(lines):
+    # inverse of format_points: (p_idx, latitudes, longitudes)
+    lines = [line for line in lines if line.strip()]
+    fields = ",".join(line.strip() for line in lines).split(",")
+    p_idx = pipeline.parse_point_names(fields[0::3])
+    coordinates = []
+    for dms in (fields[1::3], fields[2::3]):
+        parts = np.array(" ".join(dms).split(), dtype=float).reshape(-1, 3)
+        # _dec_to_dms truncates, so all three parts carry the sign
+        coordinates.append(parts[:, 0] + parts[:, 1]/60. + parts[:, 2]/3600.)
+    return p_idx, coordinates[0], coordinates[1]
+
+
+def synthetic_shift(longitudes, latitudes):
+    # smooth made-up datum shift, in arc-seconds (longitude positive east)
+    return (1.2 + 0.05*(latitudes - 46) + 0.02*np.sin(longitudes),
+            -0.8 + 0.03*(longitudes - 25) + 0.02*np.cos(latitudes))
+
+
+class HTTPTransformationService:
+    """Posts each batch as text to url and returns the response body."""
+
+    def __init__(self, url, headers=None, timeout=300, encoding="utf-8"):
+        self.url = url
+        self.headers = headers or {"Content-Type": "text/plain"}
+        self.timeout = timeout
+        self.encoding = encoding
+
+    def _post(self, body):
+        request = urllib.request.Request(self.url, data=body,
+                                         headers=self.headers, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status != 200:
+                raise Exception("Transformation service answered with "
+                                "status {0}".format(response.status))
+            return response.read().decode(self.encoding)
+
+    async def transform(self, lines):
+        body = "".join(lines).encode(self.encoding)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._post, body)
+
+
+class LocalTransformationService:
+    """Offline stand-in for the transformation service.
+
+    Applies shift (synthetic_shift by default) and projects the result
+    with projection, after an optional latency; a failure_rate share of
+    the requests fails, to exercise the retry logic.
+    """
+
+    def __init__(self, projection=projections.STEREO70, shift=synthetic_shift,
+                 latency=0.0, failure_rate=0.0, seed=None):
+        self.projection = projection
+        self.shift = shift
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+
+    async def transform(self, lines):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.random.random() < self.failure_rate:
+            self.failures += 1
+            raise Exception("Simulated transformation service failure")
+        p_idx, latitudes, longitudes = parse_points(lines)
+        lat_shift, long_shift = self.shift(longitudes, latitudes)
+        eastings, northings = self.projection.forward(
+            longitudes - long_shift/3600., latitudes - lat_shift/3600.)
+        # answers come back in a different order than they were sent
+        order = np.arange(len(p_idx))[::-1]
+        return "".join(["P%d,%.4f,%.4f\n" % result for result in
+                        zip(p_idx[order].tolist(), eastings[order].tolist(),
+                            northings[order].tolist())])
+
+
+class BatchSubmitter:
+    """Sends a point stream to a service in batches, keeping up to
+    max_in_flight requests running and retrying failed batches with
+    exponential backoff. Results are written in pointName order."""
+
+    def __init__(self, service, batch_size=10000, max_in_flight=4,
+                 retries=5, backoff=1.0, max_backoff=60.0):
+        if batch_size < 1 or max_in_flight < 1:
+            raise Exception("Batch size and requests in flight have to be "
+                            "positive!")
+        self.service = service
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retried = 0
+
+    def _batches(self, chunks):
+        buffered = []
+        buffered_count = 0
+        for p_idx, latitudes, longitudes in chunks:
+            buffered.append((p_idx, latitudes, longitudes))
+            buffered_count += len(p_idx)
+            while buffered_count >= self.batch_size:
+                merged = [np.concatenate(parts) for parts in zip(*buffered)]
+                batch = [part[:self.batch_size] for part in merged]
+                rest = [part[self.batch_size:] for part in merged]
+                buffered = [tuple(rest)]
+                buffered_count = len(rest[0])
+                yield batch
+        if buffered_count:
+            yield [np.concatenate(parts) for parts in zip(*buffered)]
+
+    async def _transform_batch(self, semaphore, batch):
+        lines = format_points(*batch)
+        attempt = 0
+        while True:
+            async with semaphore:
+                try:
+                    text = await self.service.transform(lines)
+                    results = [line for line in text.splitlines()
+                               if line.strip()]
+                    if len(results) != len(lines):
+                        raise Exception(
+                            "Service returned {0} results for {1} points".format(
+                                len(results), len(lines)))
+                    names = pipeline.parse_point_names(
+                        [line.split(",", 1)[0] for line in results])
+                    order = np.argsort(names, kind="mergesort")
+                    # the same points have to come back, in any order
+                    if not np.array_equal(names[order], np.sort(batch[0])):
+                        raise Exception("Service returned other points than "
+                                        "the ones submitted")
+                    break
+                except Exception:
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+                    self.retried += 1
+            await asyncio.sleep(min(self.max_backoff,
+                                    self.backoff * 2 ** (attempt - 1)))
+        return [results[i] + "\n" for i in order]
+
+    async def submit(self, chunks, output_path):
+        """chunks is an iterable of (p_idx, latitudes, longitudes), such as
+        Generator.iter_point_chunks() yields; returns the number of points
+        transformed."""
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        pending = []
+        written = 0
+        with open(output_path, "w", 1 << 20) as output:
+            try:
+                for batch in self._batches(chunks):
+                    pending.append(asyncio.ensure_future(
+                        self._transform_batch(semaphore, batch)))
+                    # bounded look-ahead keeps the reorder buffer small
+                    while len(pending) > 2 * self.max_in_flight:
+                        results = await pending.pop(0)
+                        output.write("".join(results))
+                        written += len(results)
+                while pending:
+                    results = await pending.pop(0)
+                    output.write("".join(results))
+                    written += len(results)
+            finally:
+                for task in pending:
+                    task.cancel()
+        return written
+
+    def run(self, chunks, output_path):
+        return asyncio.run(self.submit(chunks, output_path))